@@ -5,10 +5,12 @@ Alex Berg and Nikki Kyllonen
 '''
 from __future__ import print_function
 
-import CorpusBuilder, DecisionMaker, State, GoldStandardBuilder
-import os, sys
+# Started before the other imports so startup time includes them
+import time
+startTime = time.perf_counter()
 
-from terminaltables import AsciiTable
+import CorpusBuilder, CorpusLog, DecisionMaker, State, GoldStandardBuilder, GridSolver, Profiler, QueryServer
+import os, sys
 
 # Requires python-dotenv to be installed
 from dotenv import load_dotenv
@@ -23,6 +25,8 @@ if __name__ == "__main__":
     """ Main function driving program """
     # Process command line input
     State.processCommands(sys.argv)
+    if State.PROFILE:
+        Profiler.start()
 
     # Load local .env file if it exists
     env_path = Path(".") / ".env"
@@ -40,17 +44,77 @@ if __name__ == "__main__":
 
     # Load corpus
     #CorpusBuilder.setup_keys()  
-    corpus = {}
+    corpusFile = State.DICT_FILE
     if State.CORPORA == State.CORPORA.DICTIONARY:
-        corpus = CorpusBuilder.load_data_from_data_file(State.DICT_FILE)
+        corpusFile = State.DICT_FILE
     elif State.CORPORA == State.CORPORA.THESAURUS:
-        corpus = CorpusBuilder.load_data_from_data_file(State.THESA_FILE)
+        corpusFile = State.THESA_FILE
     elif State.CORPORA == State.CORPORA.GOLDEN:
-        corpus = CorpusBuilder.load_data_from_data_file(State.GOLDEN_FILE)
-        
+        corpusFile = State.GOLDEN_FILE
+    corpusFiles = [ corpusFile ]
+    if State.CORPORA == State.CORPORA.FUSED:
+        corpusFiles = [ f for _, f in DecisionMaker.fused_sources() ]
+        corpusFile = " + ".join(corpusFiles)
+
+    if State.COMPACT:
+        goldFile = GoldStandardBuilder.DATA_DIRECTORY + GoldStandardBuilder.ANSWER_CLUE_DATA_FILE_NAME
+        for filename in (State.DICT_FILE, State.THESA_FILE, State.GOLDEN_FILE, goldFile):
+            if CorpusLog.pending(filename):
+                merged = CorpusBuilder.compact_corpus(filename)
+                print(State.LABEL, "COMPACTED {} LOG RECORDS INTO {}".format(merged, filename))
+        exit()
+
+    if State.SHARDS and (State.CORPORA == State.CORPORA.FUSED or
+                         State.METRIC in (State.Metric.COSINE, State.Metric.GRAPH)):
+        print(State.LABEL, "--shards NEEDS ONE CORPUS AND THE JACCARD OR VECTOR METRIC, LOADING THE WHOLE CORPUS")
+        State.SHARDS = False
+
+    if State.COMPILE:
+        if State.SHARDS:
+            DecisionMaker.compile_shards(corpusFile)
+            print(State.LABEL, "COMPILED", corpusFile, "TO", DecisionMaker.shard_directory(corpusFile))
+        elif State.CORPORA == State.CORPORA.FUSED:
+            DecisionMaker.compile_fused_corpus()
+            print(State.LABEL, "COMPILED", corpusFile, "TO", DecisionMaker.fused_compiled_file())
+        else:
+            DecisionMaker.compile_corpus(corpusFile)
+            print(State.LABEL, "COMPILED", corpusFile, "TO", DecisionMaker.compiled_file(corpusFile))
+        exit()
+
+    # Building the gold standard scrapes clues and needs no corpus
     if State.BUILD_GOLD:
         GoldStandardBuilder.build_gold_standard()
         exit()
+
+    if State.METRIC == State.Metric.VECTOR and not os.path.exists(State.VECTORS_FILE):
+        print("NO WORD VECTORS FILE FOUND AT", State.VECTORS_FILE)
+        exit()
+
+    # Memory-map the compiled corpus if there is one, otherwise build the
+    # search indexes from the JSON once up front instead of on every query
+    if State.CORPORA == State.CORPORA.FUSED:
+        corpus = DecisionMaker.load_fused_corpus(State.LENGTHS)
+    elif State.SHARDS:
+        corpus = DecisionMaker.load_sharded_corpus(corpusFile, State.LENGTHS)
+    else:
+        corpus = DecisionMaker.load_corpus(corpusFile, State.LENGTHS)
+    for filename in corpusFiles:
+        if CorpusLog.pending(filename):
+            print(State.LABEL, "NEW ENTRIES FOR", filename, "ARE NOT COMPACTED YET, RUN WITH --compact")
+
+    # Report startup time so regressions are visible
+    if State.DEBUG or State.STARTUP:
+        print(State.LABEL, "STARTUP TOOK {:.3f} SECONDS".format(time.perf_counter() - startTime))
+    if State.STARTUP:
+        exit()
+
+    if State.SERVE:
+        QueryServer.serve(corpus, corpusFile)
+        exit()
+
+    if State.GRID_FILE:
+        GridSolver.run_grid(corpus, State.GRID_FILE)
+        exit()
      
     # User input + Get possible words
     if not State.EVAL:
@@ -59,11 +123,20 @@ if __name__ == "__main__":
         while (prompting):
             wordLen = int(input("\nLength of mystery word: "))
             wordHint = str(input("Hint for mystery word: "))
+            wordPattern = str(input("Known letters, _ for unknown (optional): ")).strip()
+
+            if wordPattern and len(wordPattern) != wordLen:
+                print("\nKnown letters must be {} characters long".format(wordLen))
+                continue
+
+            if State.LENGTHS and wordLen not in State.LENGTHS:
+                print("\nOnly words of lengths {} were loaded".format(sorted(State.LENGTHS)))
+                continue
 
             if State.DEBUG:
                 print("[DEBUG] Cleaned hint:" , DecisionMaker.clean_string(wordHint))
 
-            possibleWords = DecisionMaker.get_possible_words(corpus, wordLen, wordHint)
+            possibleWords = DecisionMaker.get_possible_words(corpus, wordLen, wordHint, wordPattern)
             
             if len(possibleWords) > 0:
                 print("\nPossible words:")
@@ -77,4 +150,10 @@ if __name__ == "__main__":
     # Evaluate
     else:
         golden = CorpusBuilder.load_data_from_data_file(State.GOLDEN_FILE)
-        DecisionMaker.run_evaluation(corpus, golden)
+        if State.EVAL_ALL:
+            DecisionMaker.run_full_evaluation(corpus, golden)
+        else:
+            DecisionMaker.run_evaluation(corpus, golden)
+
+        if State.APPROX:
+            DecisionMaker.run_approx_recall(corpus, golden)
@@ -0,0 +1,199 @@
+'''
+Benchmark: module for measuring ACVC query latency, evaluation throughput
+and corpus load cost
+
+Runs offline against the shipped backup corpora and writes the results as
+JSON so runs can be compared:
+
+    $ python Benchmark.py --out before.json
+    $ python Benchmark.py --out after.json --compare before.json
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import contextlib, io, json, os, platform, random, sys, time, tracemalloc
+
+import CorpusBuilder, DecisionMaker, State
+
+## GLOBAL VARIABLES ##
+CORPUS_FILE = "data/definition_data_backup_pretty.json"
+GOLDEN_FILE = "data/answer_clue_data_backup_pretty.json"
+QUERIES = 300
+EVAL_SAMPLES = 150
+EVAL_LOOPS = 10
+SEED = 5801
+
+# A result regresses when it is this much worse than the compared run
+REGRESSION_THRESHOLD = 0.20
+
+
+## HELPER FUNCTIONS ##
+def percentiles(times):
+    """ Summarize a list of durations in seconds as millisecond percentiles """
+    times = sorted(times)
+
+    def pick(p):
+        return 1000 * times[min(len(times) - 1, int(p * len(times)))]
+
+    return {"p50_ms" : pick(0.50), "p90_ms" : pick(0.90), "p99_ms" : pick(0.99),
+            "max_ms" : 1000 * times[-1], "mean_ms" : 1000 * sum(times) / len(times)}
+
+
+def measure_load(label, load):
+    """ Time a corpus load and track its peak Python memory """
+    tracemalloc.start()
+    start = time.perf_counter()
+    corpus = load()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return corpus, {"name" : label, "seconds" : seconds, "peak_mb" : peak / 2 ** 20}
+
+
+## MODULE FUNCTIONS ##
+def bench_load():
+    """ Load cost of the JSON loader, JSON plus preparation, streaming plus
+        preparation, and the compiled file """
+    results = []
+    _, stats = measure_load("load_data_from_data_file",
+                            lambda: CorpusBuilder.load_data_from_data_file(CORPUS_FILE))
+    results.append(stats)
+
+    corpus, stats = measure_load("load_and_prepare",
+                                 lambda: DecisionMaker.prepare_corpus(
+                                     CorpusBuilder.load_data_from_data_file(CORPUS_FILE)))
+    results.append(stats)
+
+    _, stats = measure_load("stream_and_prepare",
+                            lambda: DecisionMaker.CorpusIndex.prepare_items(
+                                CorpusBuilder.iter_data_file(CORPUS_FILE), DecisionMaker.tokenize))
+    results.append(stats)
+
+    compiled = os.path.join(State.CACHE_DIRECTORY, "benchmark_corpus.acvc")
+    DecisionMaker.CorpusIndex.write(corpus, compiled)
+    _, stats = measure_load("load_compiled", lambda: DecisionMaker.CorpusIndex.load(compiled))
+    results.append(stats)
+    os.remove(compiled)
+
+    return corpus, results
+
+
+def bench_queries(corpus, golden):
+    """ Per-query latency of get_possible_words under every available metric """
+    rng = random.Random(SEED)
+    answers = rng.sample(list(golden.keys()), QUERIES)
+    queries = [ (len(a), rng.choice(golden[a])) for a in answers ]
+
+    results = {}
+    metric = State.METRIC
+    for m in State.Metric:
+        if m == State.Metric.VECTOR and not os.path.exists(State.VECTORS_FILE):
+            results[m.name] = {"skipped" : "no word vectors file at " + State.VECTORS_FILE}
+            continue
+
+        State.METRIC = m
+        DecisionMaker.get_possible_words(corpus, *queries[0])   # build lazy indexes first
+        DecisionMaker.tokenize_hint.cache_clear()   # every metric pays for tokenizing the hints
+        times = []
+        for wordLen, hint in queries:
+            start = time.perf_counter()
+            DecisionMaker.get_possible_words(corpus, wordLen, hint)
+            times.append(time.perf_counter() - start)
+        results[m.name] = percentiles(times)
+
+        DecisionMaker.tokenize_hint.cache_clear()
+        start = time.perf_counter()
+        DecisionMaker.get_possible_words_batch(corpus, queries)
+        results[m.name]["batch_queries_per_s"] = len(queries) / (time.perf_counter() - start)
+    State.METRIC = metric
+
+    return results
+
+
+def bench_evaluation(corpus, golden):
+    """ Throughput of run_evaluation in scored clues per second """
+    samples, loops, seed = State.SAMPLES, State.LOOPS, State.SEED
+    State.SAMPLES, State.LOOPS, State.SEED = EVAL_SAMPLES, EVAL_LOOPS, SEED
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        DecisionMaker.run_evaluation(corpus, golden)
+    seconds = time.perf_counter() - start
+
+    State.SAMPLES, State.LOOPS, State.SEED = samples, loops, seed
+    return {"metric" : State.METRIC.name, "samples" : EVAL_SAMPLES, "loops" : EVAL_LOOPS,
+            "workers" : State.WORKERS, "seconds" : seconds,
+            "clues_per_s" : EVAL_SAMPLES * EVAL_LOOPS / seconds}
+
+
+def run_benchmarks():
+    """ Run every benchmark and return the results as a JSON-ready dict """
+    # Measure the scoring itself, not repeated queries answered from the cache
+    State.QUERY_CACHE_SIZE = 0
+    corpus, load = bench_load()
+    golden = CorpusBuilder.load_data_from_data_file(GOLDEN_FILE)
+
+    return {
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "corpus" : CORPUS_FILE,
+        "golden" : GOLDEN_FILE,
+        "load" : load,
+        "queries" : bench_queries(corpus, golden),
+        "evaluation" : bench_evaluation(corpus, golden),
+    }
+
+
+def compare(old, new):
+    """ Print how new results compare to old ones and return the regressions """
+    checks = []
+    oldLoads = { stats["name"] : stats for stats in old["load"] }
+    for newLoad in new["load"]:
+        oldLoad = oldLoads.get(newLoad["name"])
+        if oldLoad is None:
+            continue
+        checks.append(("load " + newLoad["name"] + " seconds", oldLoad["seconds"], newLoad["seconds"]))
+        checks.append(("load " + newLoad["name"] + " peak_mb", oldLoad["peak_mb"], newLoad["peak_mb"]))
+    for metric, stats in new["queries"].items():
+        if "p50_ms" in stats and "p50_ms" in old["queries"].get(metric, {}):
+            # p99 of a few hundred queries is too noisy to flag
+            for key in ("p50_ms", "p90_ms"):
+                checks.append(("query " + metric + " " + key, old["queries"][metric][key], stats[key]))
+    # Throughput is better when higher, so compare its inverse
+    checks.append(("evaluation ms per clue",
+                   1000 / old["evaluation"]["clues_per_s"], 1000 / new["evaluation"]["clues_per_s"]))
+
+    regressions = []
+    for name, before, after in checks:
+        change = (after - before) / before if before > 0 else 0.0
+        flag = "REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        print("{0:45} {1:12.4f} -> {2:12.4f} ({3:+.1%}) {4}".format(name, before, after, change, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+## MAIN FUNCTION ##
+if __name__ == "__main__":
+    """ Run the benchmarks: --out <file> saves results, --compare <file> checks
+        them against an earlier run and exits non-zero on regressions """
+    args = sys.argv[1:]
+    outFile = args[args.index("--out") + 1] if "--out" in args else None
+    compareFile = args[args.index("--compare") + 1] if "--compare" in args else None
+
+    results = run_benchmarks()
+    output = json.dumps(results, indent=2)
+    if outFile:
+        with open(outFile, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if compareFile:
+        with open(compareFile, "r") as f:
+            regressions = compare(json.load(f), results)
+        if regressions:
+            print("\n{} REGRESSION(S) OVER {:.0%}".format(len(regressions), REGRESSION_THRESHOLD))
+            sys.exit(1)
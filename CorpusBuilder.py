@@ -4,17 +4,30 @@ CorpusBuilder: module for constructing our personal corpus
 Alex Berg and Nikki Kyllonen
 """
 
+import asyncio
 import json
 import os
 import re
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import CorpusLog
+import HttpCache
 
-# Merriam Webster API
+
+# Merriam Webster API (base URLs can be overridden, e.g. to point at a local stub server)
 DICTIONARY_API_KEY = "" 
 THESAURUS_API_KEY = ""
-DICTIONARY_BASE_URL = "https://www.dictionaryapi.com/api/v3/references/collegiate/json/"
-THESAURUS_BASE_URL = "https://www.dictionaryapi.com/api/v3/references/thesaurus/json/"
+DICTIONARY_BASE_URL = os.environ.get("MERRIAM_WEBSTER_DICTIONARY_BASE_URL",
+                                     "https://www.dictionaryapi.com/api/v3/references/collegiate/json/")
+THESAURUS_BASE_URL = os.environ.get("MERRIAM_WEBSTER_THESAURUS_BASE_URL",
+                                    "https://www.dictionaryapi.com/api/v3/references/thesaurus/json/")
+
+# Fetching limits
+MAX_CONCURRENT_REQUESTS = 8  # requests in flight at once (also the connection pool size)
+REQUESTS_PER_SECOND = 10  # request start rate, 0 for no limit
+MAX_RETRIES = 4  # retries after a failed request before giving up on a word
+BACKOFF_SECONDS = 0.5  # first retry delay, doubled on every retry
 
 # Paths and data file names
 DATA_DIRECTORY = "./data/"
@@ -22,6 +35,9 @@ DEFINITION_DATA_FILE_NAME = "definition_data.json"
 SYNONYM_DATA_FILE_NAME = "synonym_data.json"
 WORDS_LIST_FILE_NAME = "3000_most_common_words.txt"
 
+# Characters that can continue a JSON number (see iter_data_file)
+NUMBER_CHARS = set("0123456789+-.eE")
+
 
 # Driver functions for getting either definitions or synonyms from the APIs
 def setup_keys():
@@ -41,13 +57,9 @@ def collect_dictionary_data():
     # Get words to find the definition of
     words = get_words(DATA_DIRECTORY + WORDS_LIST_FILE_NAME, start_index, end_index)
 
-    # Get old and new data to form combined dataset
-    old_definitions = load_data_from_data_file(DATA_DIRECTORY + DEFINITION_DATA_FILE_NAME)
+    # Append only the new data to the corpus log (merged into the corpus by compact_corpus)
     new_definitions = get_new_definitions(words)
-    data = {**old_definitions, **new_definitions}
-
-    # Save all data to file
-    write_data_to_data_file(DATA_DIRECTORY + DEFINITION_DATA_FILE_NAME, json.dumps(data))
+    CorpusLog.append(DATA_DIRECTORY + DEFINITION_DATA_FILE_NAME, new_definitions)
 
 
 def collect_thesaurus_data():
@@ -59,24 +71,23 @@ def collect_thesaurus_data():
 
     # Get words to find synonyms for
     words = get_words(DATA_DIRECTORY + WORDS_LIST_FILE_NAME, start_index, end_index)
-    old_synonyms = load_data_from_data_file(DATA_DIRECTORY + SYNONYM_DATA_FILE_NAME)
     new_synonyms = get_new_synonyms(words)
-    data = {**old_synonyms, **new_synonyms}
 
-    # Save all data to synonym file
-    write_data_to_data_file(DATA_DIRECTORY + SYNONYM_DATA_FILE_NAME, json.dumps(data))
+    # Append only the new data to the synonym log (merged into the corpus by compact_corpus)
+    CorpusLog.append(DATA_DIRECTORY + SYNONYM_DATA_FILE_NAME, new_synonyms)
+
+
+def compact_corpus(filename):
+    """Merge the logged new entries of a corpus file into it. Returns the number of merged
+       records."""
+    return CorpusLog.compact(filename, load_data_from_data_file)
 
 
 # Functions specific for getting definition data from a dictionary
 
 def get_new_definitions(words):
     """Create a dictionary of maps of a word to a list of its definitions."""
-    definitions = {}
-    for word in words:
-        definition = get_word_data_from_api(word, DICTIONARY_BASE_URL, DICTIONARY_API_KEY)  # get entire API JSON
-        definition = reformat_definition_json(word, definition)  # format the JSON nicely
-        definitions = {**definitions, **definition}  # merge new definition into definitions dictionary
-    return definitions
+    return fetch_words(words, DICTIONARY_BASE_URL, DICTIONARY_API_KEY, reformat_definition_json)
 
 
 def reformat_definition_json(word, old_json):
@@ -102,12 +113,7 @@ def clean_definition(definition):
 
 def get_new_synonyms(words):
     """Create a dictionary of maps of a word to a list of its synonyms."""
-    synonyms = {}
-    for word in words:
-        synonym = get_word_data_from_api(word, THESAURUS_BASE_URL, THESAURUS_API_KEY)  # get entire API JSON
-        synonym = reformat_thesaurus_json(word, synonym)  # reformat the JSON to our specification
-        synonyms = {**synonyms, **synonym}  # merge new synonym into synonyms dictionary
-    return synonyms
+    return fetch_words(words, THESAURUS_BASE_URL, THESAURUS_API_KEY, reformat_thesaurus_json)
 
 
 def reformat_thesaurus_json(word, old_json):
@@ -125,11 +131,99 @@ def reformat_thesaurus_json(word, old_json):
 
 # Utility functions - used for both definitions and synonyms
 
-def get_word_data_from_api(word, base_url, key):
-    """Get JSON data of word from Merriam Webster API."""
-    url = base_url + word + "?key=" + key
-    response = requests.get(url)
-    return response.json()
+def get_word_data_from_api(word, base_url, key, session=None):
+    """Get JSON data of word from Merriam Webster API, reusing the pooled connections
+       of session if one is given. Responses come from the on-disk cache when possible."""
+    url = get_word_url(word, base_url, key)
+    text = HttpCache.get_text(url, session)
+    try:
+        return json.loads(text)
+    except ValueError:
+        HttpCache.forget(url)  # do not keep serving a broken response
+        raise
+
+
+def get_word_url(word, base_url, key):
+    """Get the Merriam Webster API url of word."""
+    return base_url + word + "?key=" + key
+
+
+def fetch_words(words, base_url, key, reformat):
+    """Fetch API data for all words concurrently and return a dictionary mapping each word
+       to its reformatted data, in the order of words. Words that still fail after
+       retrying are reported and left out."""
+    results = dict.fromkeys(words)  # keeps the word order, filled in as responses arrive
+    asyncio.run(fetch_words_async(words, base_url, key, reformat, results))
+    return {word: data for word, data in results.items() if data is not None}
+
+
+async def fetch_words_async(words, base_url, key, reformat, results):
+    """Fetch every word with bounded concurrency and rate limiting. The blocking requests
+       calls run in a thread pool sharing one pooled session."""
+    import requests  # deferred so loading the corpus does not pay for it
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    start = time.perf_counter()
+    done = 0
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    async def fetch(word):
+        nonlocal done
+        async with semaphore:
+            for attempt in range(MAX_RETRIES + 1):
+                if not HttpCache.is_cached(get_word_url(word, base_url, key)):
+                    await limiter.wait()  # cached words need no network, so are not rate limited
+                try:
+                    data = await loop.run_in_executor(executor, get_word_data_from_api,
+                                                      word, base_url, key, session)
+                    break
+                except (requests.RequestException, ValueError) as e:
+                    if attempt == MAX_RETRIES or not is_retryable(e):
+                        print("Giving up on '{0}': {1}".format(word, e))
+                        return
+                    await asyncio.sleep(retry_delay(e, attempt))
+        results.update(reformat(word, data))  # merge new data into the single results dictionary
+        done += 1
+        if done % 100 == 0:
+            print("Fetched {0}/{1} words in {2:.1f}s".format(done, len(words), time.perf_counter() - start))
+
+    with session, ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS) as executor:
+        await asyncio.gather(*(fetch(word) for word in words))
+
+
+def is_retryable(error):
+    """Check if a failed request may succeed later (not a client error other than 429)."""
+    response = getattr(error, "response", None)
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+def retry_delay(error, attempt):
+    """Exponential backoff delay for a retry, honoring a numeric Retry-After header."""
+    response = getattr(error, "response", None)
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return BACKOFF_SECONDS * 2 ** attempt
+
+
+class RateLimiter:
+    """Spaces out request starts to at most rate per second across all tasks."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0
+
+    async def wait(self):
+        """Wait until the next request is allowed to start."""
+        now = asyncio.get_running_loop().time()
+        delay = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 
 def get_words(filename, start, end):
@@ -148,23 +242,97 @@ def get_words(filename, start, end):
     return words
 
 
-def load_data_from_data_file(filename):
+def load_data_from_data_file(filename, lengths=None):
     """Read JSON data from file. If the file is empty or does not exist, load an
-       empty JSON."""
+       empty JSON. If lengths is given, only words with one of those lengths are kept."""
+    return dict(iter_data_file(filename, lengths))
+
+
+def iter_data_file(filename, lengths=None, chunk_size=1 << 16):
+    """Yield the (word, entries) pairs of a JSON data file one at a time, reading the file
+       in chunks so the whole text is never held in memory at once. If lengths is given,
+       only words with one of those lengths are yielded. An empty or missing file yields
+       nothing."""
     try:
-        with open(filename, "r") as f:
-            data = f.read()
-        if data == "":  # check if file was empty or nonexistent
-            data = "{}"
+        f = open(filename, "r")
     except OSError:  # file could not be opened (possibly does not exist)
-        data = "{}"
-    return json.loads(data)
+        return
+
+    decoder = json.JSONDecoder()
+    with f:
+        buffer, pos = "", 0
+        eof = False
+
+        def fill():
+            """Read the next chunk, dropping the already parsed part of the buffer."""
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            eof = chunk == ""
+            buffer, pos = buffer[pos:] + chunk, 0
+
+        def next_char():
+            """Skip whitespace and return the next character ("" at the end of the file)."""
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos + 1]
+                fill()
+
+        def next_value():
+            """Decode the next JSON value, reading more of the file until it is complete."""
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A number is only complete once something other than a number
+                    # character follows it, since "1." or "1e" may go on in the next chunk
+                    if eof or (end < len(buffer) and not (isinstance(value, (int, float))
+                                                          and buffer[end] in NUMBER_CHARS)):
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def expect(char):
+            """Consume char or fail like json.loads would."""
+            nonlocal pos
+            if next_char() != char:
+                raise json.JSONDecodeError("Expecting '{0}'".format(char), buffer, pos)
+            pos += 1
+
+        def expect_end():
+            """Fail like json.loads would if anything but whitespace follows the object."""
+            if next_char() != "":
+                raise json.JSONDecodeError("Extra data", buffer, pos)
+
+        if next_char() == "":  # check if file was empty
+            return
+        expect("{")
+        if next_char() == "}":
+            expect("}")
+            expect_end()
+            return
+        while True:
+            word = next_value()
+            expect(":")
+            entries = next_value()
+            if lengths is None or len(word) in lengths:
+                yield word, entries
+            if next_char() == "}":
+                expect("}")
+                expect_end()
+                return
+            expect(",")
 
 
 def write_data_to_data_file(filename, data):
-    """Write data to file."""
-    with open(filename, "w") as f:
-        f.write(data)
+    """Write data to file, replacing it atomically so a crash cannot leave it half written."""
+    CorpusLog.write_atomic(filename, data)
 
 
 def json_iterator(json_input, lookup_key):
@@ -0,0 +1,867 @@
+'''
+CorpusIndex: module for preparing a corpus for fast lookups
+
+Alex Berg and Nikki Kyllonen
+'''
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+import hashlib, json, mmap, os, sys, threading, zlib
+
+import numpy as np
+
+import VectorStore
+
+## GLOBAL VARIABLES ##
+UNKNOWN_LETTERS = set("_?.")
+
+# Compiled corpus file layout: MAGIC, header length (8 bytes, little endian),
+# JSON header with the version of the cleaning rules the definitions were
+# tokenized with and a description of every array, then the raw arrays each
+# aligned to ALIGN
+MAGIC = b"ACVCIDX2"
+ALIGN = 64
+
+
+## CLASSES ##
+class StringTable(Sequence):
+    """ Read-only sequence of strings stored as one utf-8 blob plus offsets """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        if i < 0:
+            i += len(self)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class StringIndex(Mapping):
+    """ Read-only map from the strings of a StringTable to their positions,
+        stored as the sorted CRC-32 hashes of the strings plus the matching
+        positions. Lookups binary search the hashes and compare the string in
+        the table, so it takes 8 bytes per string instead of a dict entry. """
+
+    def __init__(self, table, hashes=None, order=None):
+        self.table = table
+        if hashes is None:
+            hashes, order = hash_strings(table.blob, table.offsets)
+        self.hashes = hashes
+        self.order = order
+
+    def get(self, s, default=None):
+        ids = self.find_all([ s ])
+        return int(ids[0]) if ids[0] >= 0 else default
+
+    def find_all(self, strings):
+        """ Positions of the given strings in the table, -1 for missing ones """
+        hashes = np.array([ zlib.crc32(s.encode("utf-8")) for s in strings ], dtype=np.uint32)
+        pos = np.searchsorted(self.hashes, hashes).tolist()
+        ids = np.full(len(strings), -1, dtype=np.int64)
+        for i, (s, p) in enumerate(zip(strings, pos)):
+            # Equal hashes are adjacent, check each candidate (almost always one)
+            while p < len(self.hashes) and self.hashes[p] == hashes[i]:
+                if self.table[self.order[p]] == s:
+                    ids[i] = self.order[p]
+                    break
+                p += 1
+        return ids
+
+    def __getitem__(self, s):
+        i = self.get(s, -1)
+        if i < 0:
+            raise KeyError(s)
+        return i
+
+    def __contains__(self, s):
+        return isinstance(s, str) and self.get(s, -1) >= 0
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+
+class TokenRuns(Sequence):
+    """ Read-only sequence of per-definition token id sets, stored as one flat
+        array of token ids plus offsets """
+
+    def __init__(self, starts, ids):
+        self.starts = starts
+        self.ids = ids
+
+    def __getitem__(self, i):
+        return frozenset(self.ids[self.starts[i]:self.starts[i + 1]].tolist())
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+
+class PreparedCorpus(Mapping):
+    """ Read-only view of a corpus along with the indexes built over it.
+
+        Every definition gets an integer id in corpus order (word by word, then
+        definition by definition) so that scanning candidates in id order visits
+        them in the same order as a full scan of the corpus would. Tokens are
+        interned into ids, and everything is kept in flat NumPy arrays so the
+        same structure can be built in memory or memory-mapped from a file.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.source = None      # version of the corpus file it was loaded from
+        self.words = StringTable(arrays["words"], arrays["wordOffsets"])
+        self.definitions = StringTable(arrays["definitions"], arrays["definitionOffsets"])
+        self.vocab = StringTable(arrays["vocab"], arrays["vocabOffsets"])
+        self.wordStart = arrays["wordStart"]    # word id -> id of its first definition
+        self.defWord = arrays["defWord"]        # definition id -> word id
+        self.wordLens = arrays["wordLens"]      # word id -> word length
+        self.tokens = TokenRuns(arrays["tokenStart"], arrays["tokenIds"])
+
+        # Fused corpora: definition id -> bitmask of the sources it came from
+        self.defSources = arrays.get("defSources")
+        self.sourceNames = (StringTable(arrays["sourceNames"], arrays["sourceOffsets"])
+                            if self.defSources is not None else None)
+
+        # answer length -> word ids with that length
+        buckets, bucketStart = arrays["bucketLengths"], arrays["bucketStart"]
+        self.lengthWords = { int(buckets[i]) : arrays["bucketWords"][bucketStart[i]:bucketStart[i + 1]]
+                             for i in range(len(buckets)) }
+
+        self.letters = {}       # answer length -> (position, letter) -> bitset of words
+        self.masks = {}         # answer length -> boolean mask over definition ids
+        self.rows = {}          # answer length -> sorted definition ids
+        self.tokenMatrices = {} # answer length -> sparse (definition x token) matrix
+        self._vocabIndex = None
+        self._wordIndex = None
+        self._tfidf = None
+        self._sourceTfidf = {}  # fused corpora: source bit -> TF-IDF index of that source
+        self._sentences = None
+        self._minhash = {}
+        self._synonyms = None
+
+    def index_bytes(self):
+        """ Bytes of the indexes built on the heap on first use (letter
+            bitsets, length masks and rows, token matrices, TF-IDF and MinHash
+            indexes), which a memory-mapped corpus holds on top of its file """
+        total = sum( sys.getsizeof(bits) for letters in list(self.letters.values())
+                     for bits in list(letters.values()) )
+        for built in (self.masks, self.rows, self.tokenMatrices):
+            total += sum( array_bytes(a) for a in list(built.values()) )
+        for index in [ self._tfidf ] + list(self._sourceTfidf.values()) + list(self._minhash.values()):
+            if index is not None:
+                total += index.nbytes()
+        return total
+
+    def vocab_index(self):
+        """ StringIndex mapping token -> token id (hashed on first use when the
+            arrays were compiled without one) """
+        if self._vocabIndex is None:
+            self._vocabIndex = StringIndex(self.vocab, self.arrays.get("vocabHashes"),
+                                           self.arrays.get("vocabOrder"))
+        return self._vocabIndex
+
+    def word_index(self):
+        """ StringIndex mapping word -> word id (hashed on first use when the
+            arrays were compiled without one) """
+        if self._wordIndex is None:
+            self._wordIndex = StringIndex(self.words, self.arrays.get("wordHashes"),
+                                          self.arrays.get("wordOrder"))
+        return self._wordIndex
+
+    def encode(self, tokens):
+        """ Map a token set to token ids. Tokens missing from the vocabulary get
+            distinct negative ids so set sizes (and jaccard values) are kept. """
+        tokens = list(tokens)
+        ids = self.vocab_index().find_all(tokens).tolist()
+        return frozenset( t if t >= 0 else -1 - i for i, t in enumerate(ids) )
+
+    def candidates(self, wordLen, tokenIds):
+        """ Return the sorted ids of definitions of words with length wordLen
+            sharing at least one token id with the given token ids """
+        postingKeys, postingStart = self.arrays["postingKeys"], self.arrays["postingStart"]
+        keys = np.array(sorted( wordLen * len(self.vocab) + t for t in tokenIds if t >= 0 ),
+                        dtype=np.int64)
+        pos = np.searchsorted(postingKeys, keys)
+        hit = pos < len(postingKeys)
+        pos, keys = pos[hit], keys[hit]
+        pos = pos[postingKeys[pos] == keys]
+
+        found = [ self.arrays["postingDefs"][postingStart[p]:postingStart[p + 1]] for p in pos ]
+        if len(found) == 0:
+            return []
+        return np.unique(np.concatenate(found)).tolist()
+
+    def letter_index(self, wordLen):
+        """ Return the (position, letter) -> bitset index for words of length
+            wordLen, building it on first use. Bit i of a bitset stands for
+            the i-th word in lengthWords[wordLen]. """
+        if wordLen not in self.letters:
+            wordIds = self.lengthWords.get(wordLen, [])
+            positions = {}
+            for bit, wordId in enumerate(wordIds):
+                for pos, letter in enumerate(self.words[wordId]):
+                    positions.setdefault((pos, letter.lower()), []).append(bit)
+            self.letters[wordLen] = { key : to_bitset(bits, len(wordIds))
+                                      for key, bits in positions.items() }
+        return self.letters[wordLen]
+
+    def pattern_definitions(self, wordLen, pattern):
+        """ Return the sorted ids of definitions whose word has length wordLen
+            and agrees with every known letter of pattern (e.g. "_a__e") """
+        wordIds = self.lengthWords.get(wordLen, [])
+        if len(pattern) != wordLen or len(wordIds) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Intersect the bitsets of every known letter
+        index = self.letter_index(wordLen)
+        bits = (1 << len(wordIds)) - 1
+        for pos, letter in enumerate(pattern.lower()):
+            if letter not in UNKNOWN_LETTERS:
+                bits &= index.get((pos, letter), 0)
+
+        matches = np.asarray(wordIds, dtype=np.int64)[from_bitset(bits, len(wordIds))]
+        ranges = [ np.arange(self.wordStart[w], self.wordStart[w + 1]) for w in matches.tolist() ]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def length_mask(self, wordLen):
+        """ Boolean mask over definition ids whose word has length wordLen """
+        if wordLen not in self.masks:
+            self.masks[wordLen] = self.wordLens[self.defWord] == wordLen
+        return self.masks[wordLen]
+
+    def length_rows(self, wordLen):
+        """ Sorted ids of definitions whose word has length wordLen """
+        if wordLen not in self.rows:
+            self.rows[wordLen] = np.flatnonzero(self.length_mask(wordLen))
+        return self.rows[wordLen]
+
+    def token_matrix(self, wordLen):
+        """ Binary sparse matrix with one row per definition in length_rows(wordLen)
+            and one column per token id, built on first use """
+        if wordLen not in self.tokenMatrices:
+            from scipy import sparse
+            defIds = self.length_rows(wordLen)
+            starts, ids = self.tokens.starts, self.tokens.ids
+
+            # Gather the token id runs of just these definitions
+            counts = starts[defIds + 1] - starts[defIds]
+            indptr = np.zeros(len(defIds) + 1, dtype=np.int64)
+            np.cumsum(counts, out=indptr[1:])
+            gather = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts[defIds], counts)
+            self.tokenMatrices[wordLen] = sparse.csr_matrix(
+                (np.ones(indptr[-1], dtype=np.int32), ids[gather], indptr),
+                shape=(len(defIds), len(self.vocab)))
+        return self.tokenMatrices[wordLen]
+
+    def length_fingerprint(self, wordLen):
+        """ Hex digest of the words of length wordLen in order, with their
+            definitions (and sources), i.e. everything a query for that length
+            is scored against apart from corpus wide statistics """
+        digest = hashlib.blake2b(digest_size=16)
+        wordIds = self.lengthWords.get(wordLen, [])
+        offsets, blob = self.definitions.offsets, self.definitions.blob
+        for wordId in np.asarray(wordIds).tolist():
+            first, last = int(self.wordStart[wordId]), int(self.wordStart[wordId + 1])
+            digest.update(self.words[wordId].encode("utf-8") + b"\0")
+            digest.update((offsets[first:last + 1] - offsets[first]).astype(np.int64).tobytes())
+            digest.update(bytes(blob[offsets[first]:offsets[last]]))
+            if self.defSources is not None:
+                digest.update(self.defSources[first:last].tobytes())
+        return digest.hexdigest()
+
+    def best_definitions(self, defIds, scores):
+        """ Given definition ids and their scores, return (word id, definition id)
+            pairs for the best scoring definition of every word, in word order """
+        if len(defIds) == 0:
+            return []
+
+        # Sort by word, then by descending score, then by definition id so the
+        # first entry for each word is its earliest best definition
+        wordIds = self.defWord[defIds]
+        order = np.lexsort((defIds, -scores, wordIds))
+        _, first = np.unique(wordIds[order], return_index=True)
+        best = defIds[order[first]]
+        return list(zip(wordIds[order[first]].tolist(), best.tolist()))
+
+    def tfidf(self):
+        """ Return the TF-IDF index for this corpus, building it on first use """
+        if self._tfidf is None:
+            self._tfidf = TfidfIndex(self)
+        return self._tfidf
+
+    def source_tfidf(self, bit):
+        """ Return the TF-IDF index of just the definitions of the bit-th source
+            of a fused corpus, building it on first use """
+        if bit not in self._sourceTfidf:
+            self._sourceTfidf[bit] = TfidfIndex(self, (self.defSources >> bit) & 1 == 1)
+        return self._sourceTfidf[bit]
+
+    def minhash(self, bands, rows):
+        """ Return the MinHash/LSH index with the given banding, building it on
+            first use """
+        if (bands, rows) not in self._minhash:
+            self._minhash[(bands, rows)] = MinHashIndex(self, bands, rows)
+        return self._minhash[(bands, rows)]
+
+    def synonym_graph(self):
+        """ Return the synonym graph of this corpus, building it on first use """
+        if self._synonyms is None:
+            self._synonyms = SynonymGraph(self)
+        return self._synonyms
+
+    def sentences(self, wordVectors, cacheDir):
+        """ Return the definition vector index for this corpus, loading or
+            building its memory-mapped matrix on first use """
+        if self._sentences is None or self._sentences.wordVectors is not wordVectors:
+            self._sentences = VectorStore.SentenceIndex(self, wordVectors, cacheDir)
+        return self._sentences
+
+    def __getitem__(self, word):
+        wordId = self.word_index()[word]
+        return self.definitions[self.wordStart[wordId]:self.wordStart[wordId + 1]]
+
+    def __contains__(self, word):
+        return word in self.word_index()
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+
+class ShardedCorpus(Mapping):
+    """ Read-only corpus split into one compiled corpus file per answer length.
+
+        Queries only ever look at the words of one length, so a shard is
+        memory-mapped the first time its length is asked for and kept while
+        the loaded shards fit in the memory budget. Beyond that the least
+        recently used shards are dropped and mapped again on their next use.
+    """
+
+    def __init__(self, directory, manifest, budget, empty, lengths=None):
+        self.directory = directory
+        self.shardFiles = { int(n) : info["file"] for n, info in manifest.items()
+                            if not lengths or int(n) in lengths }
+        self.shardBytes = { int(n) : info["bytes"] for n, info in manifest.items() }
+        self.shardWords = { int(n) : info["words"] for n, info in manifest.items() }
+        self.budget = budget    # bytes of mapped shard files and their indexes kept at once
+        self.heapBytes = {}     # answer length -> bytes of the indexes built for its shard
+        self.empty = empty      # stands in for lengths without any words
+        self.source = None      # version of the corpus file the shards were built from
+        self.shards = OrderedDict()
+        self.used = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def shard(self, wordLen):
+        """ Return the prepared corpus of the words of length wordLen, mapping
+            it on first use and evicting cold shards beyond the budget """
+        with self.lock:
+            shard = self.shards.get(wordLen)
+            if shard is not None:
+                self.shards.move_to_end(wordLen)
+            elif wordLen not in self.shardFiles:
+                return self.empty
+            else:
+                shard = load(os.path.join(self.directory, self.shardFiles[wordLen]))
+                shard.source = self.source
+                self.shards[wordLen] = shard
+                self.used += self.shardBytes[wordLen]
+                self.loads += 1
+
+            # Queries build a shard's indexes on the heap after mapping it, so
+            # count them as of this shard's previous queries
+            self.used += shard.index_bytes() - self.heapBytes.get(wordLen, 0)
+            self.heapBytes[wordLen] = shard.index_bytes()
+
+            # Always keep the shard just asked for, even when it alone is over
+            # budget. Dropping a shard drops its indexes along with its mapping.
+            while self.used > self.budget and len(self.shards) > 1:
+                oldLen, _ = self.shards.popitem(last=False)
+                self.used -= self.shardBytes[oldLen] + self.heapBytes.pop(oldLen, 0)
+                self.evictions += 1
+            return shard
+
+    def length_fingerprint(self, wordLen):
+        return self.shard(wordLen).length_fingerprint(wordLen)
+
+    def stats(self):
+        """ Loaded shards and the bytes they take, mapped files and indexes """
+        with self.lock:
+            return {"loaded" : sorted(self.shards), "used_bytes" : self.used,
+                    "index_bytes" : sum(self.heapBytes.values()), "budget_bytes" : self.budget,
+                    "loads" : self.loads, "evictions" : self.evictions}
+
+    def __getitem__(self, word):
+        return self.shard(len(word))[word]
+
+    def __contains__(self, word):
+        return isinstance(word, str) and word in self.shard(len(word))
+
+    def __iter__(self):
+        for wordLen in sorted(self.shardFiles):
+            yield from self.shard(wordLen)
+
+    def __len__(self):
+        return sum( self.shardWords[wordLen] for wordLen in self.shardFiles )
+
+
+class TfidfIndex:
+    """ Sparse TF-IDF matrix over every definition of a prepared corpus.
+
+        Rows are definition ids and columns are token ids. Term frequencies are
+        binary since definitions are cleaned into token sets, and every row is
+        L2 normalized so a single matrix-vector product gives cosine scores.
+
+        Given a boolean mask over definition ids, only those definitions get
+        rows and count towards the IDF, as if they were a corpus of their own.
+    """
+
+    def __init__(self, prepared, defMask=None):
+        from scipy import sparse
+        numDefs, numTokens = len(prepared.definitions), len(prepared.vocab)
+        self.emptyId = prepared.vocab_index().get("", -1)
+
+        starts, ids = prepared.tokens.starts, prepared.tokens.ids
+        rows = np.repeat(np.arange(numDefs), np.diff(starts))
+        keep = ids != self.emptyId
+        if defMask is not None:
+            keep &= np.repeat(defMask, np.diff(starts))
+        rows, cols = rows[keep], ids[keep]
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                   shape=(numDefs, numTokens))
+
+        # Smoothed inverse document frequency per token. Tokens no definition
+        # has get 0, so hint tokens unknown to these definitions are left out
+        # of the query vector like tokens missing from the vocabulary.
+        numDocs = numDefs if defMask is None else int(np.count_nonzero(defMask))
+        docFreq = np.bincount(cols, minlength=numTokens)
+        self.idf = np.where(docFreq > 0, np.log((1 + numDocs) / (1 + docFreq)) + 1, 0.0)
+
+        weighted = counts.multiply(self.idf).tocsr()
+        norms = np.sqrt(weighted.multiply(weighted).sum(axis=1)).A1
+        norms[norms == 0] = 1
+        self.matrix = sparse.diags(1 / norms).dot(weighted).tocsr()
+        self.prepared = prepared
+        self.lengthMatrices = {}    # answer length -> rows of matrix for that length
+
+    def query_vector(self, tokenIds):
+        """ Build the normalized TF-IDF vector for a set of hint token ids """
+        cols = [ t for t in tokenIds if t >= 0 and t != self.emptyId ]
+        vec = np.zeros(len(self.idf))
+        vec[cols] = self.idf[cols]
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def query_matrix(self, tokenIdSets):
+        """ Sparse matrix of normalized TF-IDF hint vectors, one row per set of
+            hint token ids """
+        from scipy import sparse
+        rows, cols = [], []
+        for row, tokenIds in enumerate(tokenIdSets):
+            for t in tokenIds:
+                if t >= 0 and t != self.emptyId:
+                    rows.append(row)
+                    cols.append(t)
+        weights = self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights ** 2, minlength=len(tokenIdSets)))
+        return sparse.csr_matrix((weights / norms[rows], (rows, cols)),
+                                 shape=(len(tokenIdSets), len(self.idf)))
+
+    def nbytes(self):
+        return array_bytes(self.idf) + array_bytes(self.matrix) + \
+               sum( array_bytes(m) for m in list(self.lengthMatrices.values()) )
+
+    def length_matrix(self, wordLen):
+        """ Rows of the TF-IDF matrix for prepared.length_rows(wordLen) """
+        if wordLen not in self.lengthMatrices:
+            self.lengthMatrices[wordLen] = self.matrix[self.prepared.length_rows(wordLen)]
+        return self.lengthMatrices[wordLen]
+
+
+class MinHashIndex:
+    """ MinHash signatures for every definition plus LSH band tables per answer
+        length, for approximate Jaccard candidate lookup on large corpora.
+
+        Definitions sharing any band of their signature with the hint become
+        candidates, so more bands (or fewer rows per band) raise recall at the
+        cost of scoring more candidates.
+    """
+    PRIME = (1 << 31) - 1
+    SEED = 5801
+
+    def __init__(self, prepared, bands, rows):
+        self.bands, self.rows = bands, rows
+        numHashes = bands * rows
+        rng = np.random.RandomState(self.SEED)
+        self.a = rng.randint(1, self.PRIME, size=numHashes).astype(np.uint64)
+        self.b = rng.randint(0, self.PRIME, size=numHashes).astype(np.uint64)
+
+        # Hash every vocabulary token once, then look hashes up by token id
+        vocabHash = np.array([ token_hash(t) for t in prepared.vocab ], dtype=np.uint64)
+        starts, ids = prepared.tokens.starts, prepared.tokens.ids
+        numDefs = len(prepared.tokens)
+        self.signatures = np.empty((numDefs, numHashes), dtype=np.uint64)
+        chunk = 2048
+        for start in range(0, numDefs, chunk):
+            end = min(start + chunk, numDefs)
+            flat = vocabHash[ids[starts[start]:starts[end]]]
+            self.signatures[start:end] = self.signature(flat, starts[start:end] - starts[start])
+
+        # Band tables: per length and band, sorted band keys with their definition ids
+        keys = self.band_keys(self.signatures)
+        defLens = prepared.wordLens[prepared.defWord]
+        self.tables = {}
+        for wordLen in np.unique(defLens).tolist():
+            defIds = np.flatnonzero(defLens == wordLen)
+            table = []
+            for band in range(bands):
+                order = np.argsort(keys[defIds, band], kind="stable")
+                table.append((keys[defIds[order], band], defIds[order]))
+            self.tables[wordLen] = table
+
+    def nbytes(self):
+        return self.signatures.nbytes + sum( keys.nbytes + defIds.nbytes for table in self.tables.values()
+                                             for keys, defIds in table )
+
+    def signature(self, hashes, starts):
+        """ MinHash signature matrix (one row per run of token hashes, each run
+            beginning at the matching offset in starts) """
+        values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % self.PRIME
+        return np.minimum.reduceat(values, starts, axis=1).T
+
+    def band_keys(self, signatures):
+        """ Combine each band's rows of the signatures into one uint64 key """
+        keys = np.zeros((signatures.shape[0], self.bands), dtype=np.uint64)
+        for row in range(self.rows):
+            keys = keys * np.uint64(1000003) ^ signatures[:, row::self.rows][:, :self.bands]
+        return keys
+
+    def candidates(self, wordLen, tokens):
+        """ Return the sorted ids of definitions of words with length wordLen
+            sharing at least one LSH band with the given tokens """
+        table = self.tables.get(wordLen)
+        if table is None:
+            return []
+        hashes = np.array([ token_hash(t) for t in tokens ], dtype=np.uint64)
+        keys = self.band_keys(self.signature(hashes, [0]))[0]
+        found = []
+        for band, (bandKeys, defIds) in enumerate(table):
+            lo = np.searchsorted(bandKeys, keys[band], side="left")
+            hi = np.searchsorted(bandKeys, keys[band], side="right")
+            found.append(defIds[lo:hi])
+        return np.unique(np.concatenate(found)).tolist()
+
+
+class SynonymGraph:
+    """ Synonym graph of a thesaurus style corpus (word -> synonyms and related
+        words) in compressed sparse row form.
+
+        Every word and every synonym (lower cased) is a node with an integer
+        id, and each word -> synonym entry is an edge stored in both
+        directions, so the neighbours of node i are
+        indices[indptr[i]:indptr[i + 1]]. Answers are compared by their
+        compact form without spaces or dashes, as they would go into a grid.
+    """
+
+    def __init__(self, prepared):
+        nodes = {}
+        src, dst = [], []
+        for wordId in range(len(prepared.words)):
+            # Blank words and synonyms are not nodes, or empty hints would reach them
+            word = prepared.words[wordId].strip().lower()
+            if not word:
+                continue
+            a = nodes.setdefault(word, len(nodes))
+            for defId in range(int(prepared.wordStart[wordId]), int(prepared.wordStart[wordId + 1])):
+                synonym = prepared.definitions[defId].strip().lower()
+                if not synonym:
+                    continue
+                b = nodes.setdefault(synonym, len(nodes))
+                if a != b:
+                    src.extend((a, b))
+                    dst.extend((b, a))
+
+        blob, offsets = pack_strings(nodes)
+        self.nodes = StringTable(blob, offsets)
+        self.nodeIndex = StringIndex(self.nodes)
+        self.compact = [ compact_answer(n) for n in nodes ]
+        self.nodeLens = np.array([ len(c) for c in self.compact ], dtype=np.int32)
+
+        # Sort the unique edges by source node into the CSR arrays
+        numNodes = len(nodes)
+        edges = np.unique(np.array(src, dtype=np.int64) * numNodes + np.array(dst, dtype=np.int64))
+        self.indices = (edges % max(numNodes, 1)).astype(np.int32)
+        self.indptr = np.zeros(numNodes + 1, dtype=index_dtype(len(edges)))
+        np.cumsum(np.bincount(edges // max(numNodes, 1), minlength=numNodes), out=self.indptr[1:])
+
+    def node_ids(self, strings):
+        """ Node ids of the given strings, leaving out the ones not in the graph """
+        ids = self.nodeIndex.find_all([ s.strip().lower() for s in strings if s.strip() ])
+        return ids[ids >= 0]
+
+    def neighbors(self, nodeIds):
+        """ Unique ids of the nodes adjacent to any of the given nodes """
+        starts = self.indptr[nodeIds].astype(np.int64)
+        counts = self.indptr[nodeIds + 1] - starts
+        ends = np.cumsum(counts)
+        gather = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts - starts, counts)
+        return np.unique(self.indices[gather])
+
+    def expand(self, seed, hops, decay):
+        """ Ids of the nodes within hops edges of a seed node (not the seed) and
+            their scores, decay ** (hop - 1) for the first hop reaching them """
+        seen = np.array([ seed ], dtype=np.int64)
+        frontier = seen
+        found, scores = [], []
+        for hop in range(hops):
+            frontier = np.setdiff1d(self.neighbors(frontier), seen, assume_unique=True)
+            if len(frontier) == 0:
+                break
+            found.append(frontier)
+            scores.append(np.full(len(frontier), decay ** hop))
+            seen = np.union1d(seen, frontier)
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(found), np.concatenate(scores)
+
+
+## MODULE FUNCTIONS ##
+def compact_answer(s):
+    """ Form of a word or phrase as it is written into a grid """
+    return s.replace(" ", "").replace("-", "")
+
+
+def token_hash(token):
+    """ Stable 31 bit hash of a token (Python's hash() is salted per process) """
+    return zlib.crc32(token.encode("utf-8")) & MinHashIndex.PRIME
+
+
+def to_bitset(bits, size):
+    """ Pack a list of bit positions below size into a Python int """
+    mask = np.zeros(size, dtype=bool)
+    mask[bits] = True
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+
+def from_bitset(bitset, size):
+    """ Unpack a Python int bitset into the sorted array of its set positions """
+    packed = np.frombuffer(bitset.to_bytes((size + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, bitorder="little")[:size])
+
+
+def pack_strings(strings):
+    """ Pack strings into a utf-8 blob and an offsets array """
+    encoded = [ s.encode("utf-8") for s in strings ]
+    blob = b"".join(encoded)
+    offsets = np.zeros(len(encoded) + 1, dtype=index_dtype(len(blob)))
+    np.cumsum([ len(e) for e in encoded ], out=offsets[1:])
+    return np.frombuffer(blob, dtype=np.uint8), offsets
+
+
+def from_buffer(buffer, dtype):
+    """ NumPy array of a typed buffer (array.array) as dtype, sharing the
+        buffer's memory when it already has that type """
+    data = np.frombuffer(buffer, dtype=np.dtype(buffer.typecode))
+    return data if data.dtype == dtype else data.astype(dtype)
+
+
+def array_bytes(a):
+    """ Bytes of the buffers of a NumPy array or SciPy sparse matrix """
+    if hasattr(a, "indptr"):
+        return a.data.nbytes + a.indices.nbytes + a.indptr.nbytes
+    return a.nbytes
+
+
+def index_dtype(limit):
+    """ Smallest signed integer type holding positions up to limit """
+    return np.int32 if limit < 2**31 else np.int64
+
+
+def hash_strings(blob, offsets):
+    """ CRC-32 hashes of the strings packed in a blob, sorted, and the string
+        positions in the same order """
+    data = memoryview(np.ascontiguousarray(blob))
+    offsets = offsets.tolist()
+    hashes = np.array([ zlib.crc32(data[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1) ],
+                      dtype=np.uint32)
+    order = np.argsort(hashes, kind="stable")
+    return hashes[order], order.astype(np.int32)
+
+
+def build_arrays(items, tokenize):
+    """ Build the flat arrays of a prepared corpus from (word, definitions)
+        pairs. Strings go straight into utf-8 blobs and ids into typed
+        buffers as the pairs come in, so a streamed corpus never exists as
+        Python objects beyond the pair being read and the token vocabulary. """
+    vocab = {}
+    words, wordOffsets = bytearray(), array("q", [ 0 ])
+    definitions, definitionOffsets = bytearray(), array("q", [ 0 ])
+    wordStart, defWord, wordLens = array("q", [ 0 ]), array("i"), array("i")
+    tokenStart, tokenIds = array("q", [ 0 ]), array("i")
+
+    for word, values in items:
+        wordId = len(wordLens)
+        words += word.encode("utf-8")
+        wordOffsets.append(len(words))
+        wordLens.append(len(word))
+        for val in values:
+            definitions += val.encode("utf-8")
+            definitionOffsets.append(len(definitions))
+            defWord.append(wordId)
+
+            # Clean each definition exactly once and keep its sorted token ids
+            tokenIds.extend(sorted( vocab.setdefault(t, len(vocab)) for t in sorted(tokenize(val)) ))
+            tokenStart.append(len(tokenIds))
+        wordStart.append(len(defWord))
+
+    arrays = {}
+    arrays["words"] = np.frombuffer(bytes(words), dtype=np.uint8)
+    arrays["wordOffsets"] = from_buffer(wordOffsets, index_dtype(len(words)))
+    arrays["definitions"] = np.frombuffer(bytes(definitions), dtype=np.uint8)
+    arrays["definitionOffsets"] = from_buffer(definitionOffsets, index_dtype(len(definitions)))
+    arrays["vocab"], arrays["vocabOffsets"] = pack_strings(vocab)
+    vocabSize = len(vocab)
+    del vocab
+    arrays["wordStart"] = from_buffer(wordStart, index_dtype(len(defWord)))
+    arrays["defWord"] = from_buffer(defWord, np.int32)
+    arrays["wordLens"] = from_buffer(wordLens, np.int32)
+    arrays["tokenStart"] = from_buffer(tokenStart, index_dtype(len(tokenIds)))
+    arrays["tokenIds"] = from_buffer(tokenIds, np.int32)
+
+    # Length buckets: word ids grouped by length, in word id order
+    order = np.argsort(arrays["wordLens"], kind="stable")
+    lengths, bucketStart = np.unique(arrays["wordLens"][order], return_index=True)
+    arrays["bucketLengths"] = lengths.astype(np.int32)
+    arrays["bucketStart"] = np.append(bucketStart, len(order)).astype(np.int32)
+    arrays["bucketWords"] = order.astype(np.int32)
+
+    # Postings: definition ids grouped by (answer length, token id) key. The
+    # occurrences are already in definition order, so a stable sort of their
+    # keys groups them without sorting by definition as well.
+    counts = np.diff(arrays["tokenStart"])
+    keyType = index_dtype((int(arrays["wordLens"].max(initial=0)) + 1) * vocabSize)
+    occKeys = np.repeat(arrays["wordLens"][arrays["defWord"]].astype(keyType), counts)
+    occKeys *= vocabSize
+    occKeys += arrays["tokenIds"]
+    order = np.argsort(occKeys, kind="stable")
+    occKeys = occKeys[order]
+    postingStart = (np.concatenate(([ 0 ], np.flatnonzero(np.diff(occKeys)) + 1, [ len(occKeys) ]))
+                    if len(occKeys) else np.zeros(1, dtype=np.int64))
+    postingKeys = occKeys[postingStart[:-1]]
+    arrays["postingKeys"] = postingKeys.astype(index_dtype(postingKeys[-1] if len(postingKeys) else 0))
+    arrays["postingStart"] = postingStart.astype(index_dtype(len(occKeys)))
+    del occKeys
+    arrays["postingDefs"] = np.repeat(np.arange(len(defWord), dtype=np.int32), counts)[order]
+
+    # Hashed lookups of words and tokens
+    arrays["wordHashes"], arrays["wordOrder"] = hash_strings(arrays["words"], arrays["wordOffsets"])
+    arrays["vocabHashes"], arrays["vocabOrder"] = hash_strings(arrays["vocab"], arrays["vocabOffsets"])
+
+    return arrays
+
+
+def prepare(corpus, tokenize):
+    """ Build the indexes for a corpus unless it has already been prepared """
+    if isinstance(corpus, (PreparedCorpus, ShardedCorpus)):
+        return corpus
+    return PreparedCorpus(build_arrays(corpus.items(), tokenize))
+
+
+def length_corpus(corpus, wordLen):
+    """ The corpus holding the words of length wordLen: its shard when the
+        corpus is sharded, else the corpus itself """
+    return corpus.shard(wordLen) if isinstance(corpus, ShardedCorpus) else corpus
+
+
+def prepare_sources(sources, tokenize):
+    """ Build one fused corpus from (name, items) sources of (word, definitions)
+        pairs. Words and tokens are shared, a definition found in several
+        sources for the same word is stored once, and defSources records the
+        sources of every definition as a bitmask (bit i for the i-th source). """
+    names, merged = [], {}
+    for bit, (name, items) in enumerate(sources):
+        names.append(name)
+        for word, values in items:
+            definitions = merged.setdefault(word, {})
+            for val in values:
+                definitions[val] = definitions.get(val, 0) | (1 << bit)
+
+    arrays = build_arrays(( (word, list(definitions)) for word, definitions in merged.items() ), tokenize)
+    arrays["defSources"] = np.array([ mask for definitions in merged.values() for mask in definitions.values() ],
+                                    dtype=np.uint8)
+    arrays["sourceNames"], arrays["sourceOffsets"] = pack_strings(names)
+    return PreparedCorpus(arrays)
+
+
+def prepare_items(items, tokenize):
+    """ Build the indexes straight from an iterable of (word, definitions) pairs,
+        e.g. a streaming loader, without keeping a source dict around """
+    return PreparedCorpus(build_arrays(items, tokenize))
+
+
+def write(prepared, filename, tokenizer=None):
+    """ Save the arrays of a prepared corpus as a compiled corpus file, along
+        with the version of the cleaning rules its definitions were tokenized
+        with """
+    header, offset = {"tokenizer" : tokenizer, "arrays" : {}}, 0
+    for name, arr in prepared.arrays.items():
+        header["arrays"][name] = {"dtype" : arr.dtype.str, "shape" : list(arr.shape), "offset" : offset}
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    headerBytes = json.dumps(header).encode("utf-8")
+    start = -(-(len(MAGIC) + 8 + len(headerBytes)) // ALIGN) * ALIGN
+
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(headerBytes).to_bytes(8, "little"))
+        f.write(headerBytes)
+        for name, arr in prepared.arrays.items():
+            f.seek(start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, filename)
+
+
+def load(filename):
+    """ Memory-map a compiled corpus file written by write() """
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("'{0}' is not a compiled corpus file".format(filename))
+    headerLen = int.from_bytes(data[len(MAGIC):len(MAGIC) + 8], "little")
+    header = json.loads(data[len(MAGIC) + 8:len(MAGIC) + 8 + headerLen].decode("utf-8"))
+    start = -(-(len(MAGIC) + 8 + headerLen) // ALIGN) * ALIGN
+
+    arrays = {}
+    for name, info in header["arrays"].items():
+        count = int(np.prod(info["shape"]))
+        arrays[name] = np.frombuffer(data, dtype=np.dtype(info["dtype"]), count=count,
+                                     offset=start + info["offset"]).reshape(info["shape"])
+    return PreparedCorpus(arrays)
+
+
+def compiled_tokenizer(filename):
+    """ Version of the cleaning rules a compiled corpus file was tokenized
+        with, or None when the file is missing, from an older format or was
+        written without one """
+    try:
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            headerLen = int.from_bytes(f.read(8), "little")
+            return json.loads(f.read(headerLen).decode("utf-8")).get("tokenizer")
+    except (OSError, ValueError):
+        return None
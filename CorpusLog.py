@@ -0,0 +1,105 @@
+"""
+CorpusLog: module for the append-only logs of new corpus entries and their compaction
+
+New entries are appended to a JSONL log next to the corpus file instead of rewriting the
+whole corpus. Compaction merges the log into the corpus JSON that ACVC reads.
+
+Alex Berg and Nikki Kyllonen
+"""
+
+import json
+import os
+
+
+LOG_SUFFIX = ".log.jsonl"
+
+# Record operations: SET replaces the entries of a word, ADD appends new entries to them
+SET = "set"
+ADD = "add"
+
+
+def log_file_for(corpus_file):
+    """Returns the path of the log belonging to a corpus file."""
+    return os.path.splitext(corpus_file)[0] + LOG_SUFFIX
+
+
+def append(corpus_file, entries, op=SET):
+    """Append a record per word in entries (a map of word to list of entries) to the log
+       of corpus_file. Only the new data is written, and the corpus file is not touched."""
+    with open(log_file_for(corpus_file), "a") as f:
+        f.write(complete_line_prefix(f))
+        for word, values in entries.items():
+            f.write(json.dumps({"op": op, "word": word, "entries": values}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def complete_line_prefix(f):
+    """Returns a newline if the open log does not end in one (after a crash mid-write), so
+       the next record starts on a fresh line."""
+    if f.tell() == 0:
+        return ""
+    with open(f.name, "rb") as r:
+        r.seek(-1, os.SEEK_END)
+        return "" if r.read(1) == b"\n" else "\n"
+
+
+def read(corpus_file):
+    """Yields the (op, word, entries) records in the log of corpus_file, in order. A
+       partially written record left by a crash is skipped."""
+    try:
+        f = open(log_file_for(corpus_file), "r")
+    except OSError:  # no log, nothing to replay
+        return
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield record["op"], record["word"], record["entries"]
+
+
+def apply(data, op, word, values):
+    """Apply one log record to a corpus dictionary."""
+    if op == ADD:
+        existing = data.setdefault(word, [])
+        for value in values:
+            if value not in existing:
+                existing.append(value)
+    else:
+        data[word] = values
+
+
+def pending(corpus_file):
+    """Check if the corpus file has log records that are not compacted yet."""
+    return os.path.exists(log_file_for(corpus_file))
+
+
+def compact(corpus_file, load):
+    """Merge the log of corpus_file into it and remove the log. load reads the corpus
+       file into a dictionary. The corpus is replaced atomically, so a crash leaves either
+       the old or the new file, and replaying a log twice gives the same result. Returns
+       the number of records merged."""
+    if not pending(corpus_file):
+        return 0
+
+    data = load(corpus_file)
+    merged = 0
+    for op, word, values in read(corpus_file):
+        apply(data, op, word, values)
+        merged += 1
+
+    write_atomic(corpus_file, json.dumps(data))
+    os.remove(log_file_for(corpus_file))
+    return merged
+
+
+def write_atomic(filename, text):
+    """Write text to a temporary file and move it over filename."""
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
@@ -5,91 +5,766 @@ Alex Berg and Nikki Kyllonen
 '''
 from __future__ import print_function
 
-import State
-import string, nltk, random
+import State, CorpusBuilder, CorpusIndex, CorpusLog, EvalStore, Profiler, QueryCache, VectorStore
+import functools, hashlib, json, multiprocessing, os, string, random, time
 
-from nltk.corpus import stopwords
-nltk.download("stopwords")
+import numpy as np
 
 from textwrap import wrap
-from terminaltables import AsciiTable
 
 ## GLOBAL VARIABLES ##
 punc = set(string.punctuation)
-engStopWords = set(stopwords.words('english'))
+engStopWords = None
+wordVectors = None
+evalCorpus = None   # corpus shared with evaluation pool workers
+queryCache = None   # memoized possible words, created on first use
+EVAL_CHUNK = 2000   # clues scored between progress updates of --eval all
+CLEANING_VERSION = 1    # bump whenever clean_string or tokenize change their output
 
 
 ## HELPER FUNCTIONS ##
+def get_stop_words():
+    """ Load the English stopwords on first use from the bundled list, falling
+        back to an already downloaded NLTK stopwords corpus """
+    global engStopWords
+    if engStopWords is None:
+        try:
+            with open(State.STOPWORDS_FILE, "r") as f:
+                engStopWords = set( w.strip() for w in f if w.strip() )
+        except OSError:
+            from nltk.corpus import stopwords
+            engStopWords = set(stopwords.words('english'))
+    return engStopWords
+
+
 def clean_string(s):
     """ Remove double spaces, stopwords, and all punctuation """
+    stopWords = get_stop_words()
     s = s.replace("  " , " ")
-    words = [ w for w in s.split(" ") if w not in engStopWords ]
+    words = [ w for w in s.split(" ") if w not in stopWords ]
     s = " ".join(words)
     return "".join( ch.lower() for ch in s if ch not in punc )
 
 
-## MODULE FUNCTIONS ##
-def get_possible_words(corpus, wordLen, wordHint):
-    """ Construct list of possible word matches """
+def phrase_key(s):
+    """ Lower case a phrase and drop its punctuation, keeping stopwords, so it
+        can be looked up as a multi word synonym like "make up" """
+    return " ".join( "".join( ch for ch in s.lower() if ch not in punc ).split() )
+
+
+def tokenizer_version():
+    """ Identity of the cleaning rules definitions are tokenized with, from
+        CLEANING_VERSION and the stopword list, stored in compiled corpora so
+        files tokenized under other rules get compiled again """
+    digest = hashlib.blake2b(digest_size=8)
+    for w in sorted(get_stop_words()):
+        digest.update(w.encode("utf-8") + b"\0")
+    return "{}-{}".format(CLEANING_VERSION, digest.hexdigest())
+
+
+def tokenize(s):
+    """ Clean a string and split it into its set of tokens """
+    return frozenset(clean_string(s).split(" "))
+
+
+@functools.lru_cache(maxsize=1024)
+def tokenize_hint(hint):
+    """ Tokenize a hint, remembering recent hints since they are tokenized
+        both for the query cache key and for scoring """
+    return tokenize(hint)
 
-    if State.METRIC == State.Metric.JACCARD:
-        possible = use_jaccard_metric(corpus, wordLen, wordHint)
+
+def get_query_cache():
+    """ Return the shared query cache, or None when it is disabled """
+    global queryCache
+    if queryCache is None and State.QUERY_CACHE_SIZE > 0:
+        queryCache = QueryCache.QueryCache(State.QUERY_CACHE_SIZE)
+    return queryCache
+
+
+def query_settings(corpus):
+    """ The settings of the current metric that possible words depend on """
+    if State.METRIC == State.Metric.JACCARD and State.APPROX:
+        settings = (State.APPROX_BANDS, State.APPROX_ROWS)
+    elif State.METRIC == State.Metric.VECTOR:
+        settings = State.VECTORS_FILE
+    elif State.METRIC == State.Metric.GRAPH:
+        settings = (State.GRAPH_HOPS, State.GRAPH_DECAY)
+    else:
+        settings = None
+    if getattr(corpus, "defSources", None) is not None:
+        settings = (settings, tuple(sorted(State.FUSED_WEIGHTS.items())))
+    return settings
+
+
+def query_key(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Cache key of a query: everything its possible words depend on, with
+        the hint reduced to its tokens so equivalent hints share an entry.
+        The graph metric also looks the whole hint up as a phrase, so there
+        the word order of the hint is part of the key. """
+    if pattern:
+        pattern = "".join( "_" if c in CorpusIndex.UNKNOWN_LETTERS else c for c in pattern.lower() )
+    hint = tokenize_hint(wordHint)
+    if State.METRIC == State.Metric.GRAPH:
+        hint = (hint, phrase_key(wordHint))
+    return (QueryCache.corpus_key(corpus), State.METRIC, query_settings(corpus), wordLen,
+            hint, pattern or None, k)
+
+
+## MODULE FUNCTIONS ##
+def prepare_corpus(corpus):
+    """ Build the search indexes for a corpus once so queries can reuse them """
+    return CorpusIndex.prepare(corpus, tokenize)
+
+
+def compiled_file(filename, lengths=None):
+    """ Path of the compiled binary form of a corpus JSON file, or of just its
+        words with the given lengths """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(State.CACHE_DIRECTORY, name + lengths_suffix(lengths) + ".acvc")
+
+
+def lengths_suffix(lengths):
+    """ File name suffix telling apart the compiled forms of length filters """
+    return "_len" + "_".join( str(n) for n in sorted(lengths) ) if lengths else ""
+
+
+def is_current(compiled, files):
+    """ Whether a compiled file exists, is at least as new as every source
+        file and was tokenized under the current cleaning rules """
+    return os.path.exists(compiled) and all( not os.path.exists(f) or
+                                             os.path.getmtime(compiled) >= os.path.getmtime(f) for f in files ) \
+        and CorpusIndex.compiled_tokenizer(compiled) == tokenizer_version()
+
+
+def compile_in_child(compile, *args):
+    """ Run a compile function in a forked child process. Building the indexes
+        leaves this process's heap fragmented with the build's short-lived
+        objects, which would stay resident for as long as it runs, while the
+        file the child writes can be memory-mapped instead. Returns False when
+        there is no fork support or the child failed (e.g. the cache directory
+        is not writable). """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return False
+
+    def run():
+        try:
+            compile(*args)
+        except OSError as e:
+            print(State.LABEL, "COULD NOT WRITE THE COMPILED CORPUS ({}), BUILDING IT IN MEMORY".format(e))
+            os._exit(1)
+
+    child = multiprocessing.get_context("fork").Process(target = run)
+    child.start()
+    child.join()
+    return child.exitcode == 0
+
+
+def compile_corpus(filename, lengths=None):
+    """ Compile a corpus JSON file, or just its words with the given lengths,
+        into its memory-mappable binary form """
+    corpus = CorpusIndex.prepare_items(CorpusBuilder.iter_data_file(filename, lengths), tokenize)
+    CorpusIndex.write(corpus, compiled_file(filename, lengths), tokenizer_version())
+
+
+def load_corpus(filename, lengths=None):
+    """ Load a prepared corpus by memory-mapping its compiled form. A compiled
+        form at least as new as the JSON file is reused (the whole corpus one
+        serves any lengths), otherwise the JSON is compiled first, keeping only
+        words with the given lengths. Without fork support or a writable cache
+        directory the indexes are built from the JSON in memory. """
+    source = QueryCache.corpus_source([ filename ], lengths)
+    compiled = compiled_file(filename)
+    if not is_current(compiled, [ filename ]):
+        compiled = compiled_file(filename, lengths)
+        if not is_current(compiled, [ filename ]):
+            with Profiler.timer("compile json"):
+                compile_in_child(compile_corpus, filename, lengths)
+
+    if is_current(compiled, [ filename ]):
+        with Profiler.timer("load compiled"):
+            corpus = CorpusIndex.load(compiled)
+    else:
+        # Stream entries straight into the index build so the raw text and a
+        # full dict are never held at the same time
+        with Profiler.timer("load json and prepare"):
+            corpus = CorpusIndex.prepare_items(CorpusBuilder.iter_data_file(filename, lengths), tokenize)
+
+    # Cached queries are tied to this version of the file (and length filter)
+    corpus.source = source
+    return corpus
+
+
+def shard_directory(filename):
+    """ Directory of the per length compiled shards of a corpus JSON file """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(State.CACHE_DIRECTORY, name + ".shards")
+
+
+def compile_shards(filename):
+    """ Split a corpus JSON file by answer length into one compiled corpus file
+        per length, listed in a manifest written last """
+    byLength = {}
+    for word, values in CorpusBuilder.iter_data_file(filename):
+        byLength.setdefault(len(word), []).append((word, values))
+
+    directory = shard_directory(filename)
+    os.makedirs(directory, exist_ok=True)
+    manifest = {}
+    for wordLen in sorted(byLength):
+        shard = CorpusIndex.prepare_items(byLength.pop(wordLen), tokenize)
+        shardFile = "length_{}.acvc".format(wordLen)
+        CorpusIndex.write(shard, os.path.join(directory, shardFile), tokenizer_version())
+        manifest[str(wordLen)] = {"file" : shardFile, "words" : len(shard),
+                                  "bytes" : os.path.getsize(os.path.join(directory, shardFile))}
+    CorpusLog.write_atomic(os.path.join(directory, "manifest.json"), json.dumps(manifest))
+
+
+def load_sharded_corpus(filename, lengths=None):
+    """ Open the per length shards of a corpus, (re)building them first when
+        they are older than the JSON file or were tokenized under other
+        cleaning rules. Shards are only mapped when a query needs them, within
+        State.SHARD_BUDGET_MB. """
+    directory = shard_directory(filename)
+    manifestFile = os.path.join(directory, "manifest.json")
+    current = os.path.exists(manifestFile) and not (os.path.exists(filename) and
+                                                    os.path.getmtime(manifestFile) < os.path.getmtime(filename))
+    if current:
+        with open(manifestFile, "r") as f:
+            manifest = json.load(f)
+        current = all( is_current(os.path.join(directory, info["file"]), [ filename ]) for info in manifest.values() )
+    if not current:
+        with Profiler.timer("compile shards"):
+            compile_shards(filename)
+        with open(manifestFile, "r") as f:
+            manifest = json.load(f)
+
+    corpus = CorpusIndex.ShardedCorpus(directory, manifest, State.SHARD_BUDGET_MB << 20,
+                                       prepare_corpus({}), lengths)
+    corpus.source = QueryCache.corpus_source([ filename ], lengths)
+    return corpus
+
+
+def fused_sources():
+    """ (name, corpus file) of every source searched together in fused mode """
+    return [ ("dictionary", State.DICT_FILE), ("thesaurus", State.THESA_FILE), ("golden", State.GOLDEN_FILE) ]
+
+
+def fused_compiled_file(lengths=None):
+    """ Path of the compiled binary form of the fused corpus, or of just its
+        words with the given lengths """
+    return os.path.join(State.CACHE_DIRECTORY, "fused" + lengths_suffix(lengths) + ".acvc")
+
+
+def compile_fused_corpus(lengths=None):
+    """ Compile all fused sources, or just their words with the given lengths,
+        into one memory-mappable binary file """
+    corpus = CorpusIndex.prepare_sources([ (name, CorpusBuilder.iter_data_file(f, lengths))
+                                           for name, f in fused_sources() ], tokenize)
+    CorpusIndex.write(corpus, fused_compiled_file(lengths), tokenizer_version())
+
+
+def load_fused_corpus(lengths=None):
+    """ Load the dictionary, thesaurus and golden corpora as one prepared corpus
+        with a shared vocabulary, memory-mapping its compiled form like
+        load_corpus does (compiling it first when it is older than any source
+        file) """
+    files = [ f for _, f in fused_sources() ]
+    source = QueryCache.corpus_source(files, lengths)
+    compiled = fused_compiled_file()
+    if not is_current(compiled, files):
+        compiled = fused_compiled_file(lengths)
+        if not is_current(compiled, files):
+            with Profiler.timer("compile json"):
+                compile_in_child(compile_fused_corpus, lengths)
+
+    if is_current(compiled, files):
+        with Profiler.timer("load compiled"):
+            corpus = CorpusIndex.load(compiled)
+    else:
+        with Profiler.timer("load json and prepare"):
+            corpus = CorpusIndex.prepare_sources([ (name, CorpusBuilder.iter_data_file(f, lengths))
+                                                   for name, f in fused_sources() ], tokenize)
+    corpus.source = source
+    return corpus
+
+
+def get_possible_words(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Construct list of the top k possible word matches. An optional pattern
+        of known letters (e.g. "_a__e") narrows the candidates before scoring. """
+    corpus = CorpusIndex.length_corpus(corpus, wordLen)
+    cache = get_query_cache() if isinstance(corpus, CorpusIndex.PreparedCorpus) else None
+    if cache is not None:
+        key = query_key(corpus, wordLen, wordHint, pattern, k)
+        cached = cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+    if State.METRIC == State.Metric.GRAPH:
+        possible = use_graph_metric(corpus, wordLen, wordHint, pattern, k)
+    elif getattr(corpus, "defSources", None) is not None:
+        possible = use_fused_metric(corpus, wordLen, wordHint, pattern, k)
+    elif State.METRIC == State.Metric.JACCARD:
+        possible = use_jaccard_metric(corpus, wordLen, wordHint, pattern, k)
     elif State.METRIC == State.Metric.COSINE:
-        # TODO: cosine similarity metric
-        possible = [("example", 0.5, "some def")]
+        possible = use_cosine_metric(corpus, wordLen, wordHint, pattern, k)
+    elif State.METRIC == State.Metric.VECTOR:
+        possible = use_vector_metric(corpus, wordLen, wordHint, pattern, k)
 
-    # sort and only keep the top 10 possible words
-    possible = sorted(possible, key = lambda x : x[1], reverse=True)[:10]
+    # sort and only keep the top k possible words
+    with Profiler.timer("sort"):
+        possible = sorted(possible, key = lambda x : x[1], reverse=True)[:k]
 
+    if cache is not None:
+        cache.put(key, tuple(possible))
     return possible
 
 
-def use_jaccard_metric(corpus, wordLen, wordHint):
-    """ Use brute force with jaccard similarity metric """ 
-    possible = []
-    for word in list(corpus.keys()):
-        if len(word) == wordLen:
-            maxJaccard = 0
-            maxJaccardString = ""
-            for val in corpus[word]:
-                m = max(maxJaccard, jaccard(wordHint, val))
-                if (m != maxJaccard):
-                    maxJaccardString = val
-                    maxJaccard = m
-            if maxJaccard > 0:
-                possible.append((word, maxJaccard, maxJaccardString))
+def use_jaccard_metric(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Score only the definitions sharing at least one token with the hint """
+    corpus = prepare_corpus(corpus)
+    with Profiler.timer("clean"):
+        hintTokens = tokenize_hint(wordHint)
+        hintIds = corpus.encode(hintTokens)
+
+    with Profiler.timer("filter"):
+        if pattern:
+            candidates = corpus.pattern_definitions(wordLen, pattern).tolist()
+        elif State.APPROX:
+            candidates = corpus.minhash(State.APPROX_BANDS, State.APPROX_ROWS).candidates(wordLen, hintTokens)
+        else:
+            candidates = corpus.candidates(wordLen, hintIds)
+    if State.PROFILE:
+        Profiler.count("definitions of length", len(corpus.length_rows(wordLen)))
+    Profiler.count("definitions scored", len(candidates))
+
+    # Candidates come back in corpus order, so ties resolve like a full scan
+    with Profiler.timer("score"):
+        best = {}
+        for defId in candidates:
+            wordId = int(corpus.defWord[defId])
+            score = jaccard_tokens(hintIds, corpus.tokens[defId])
+            if score > best.get(wordId, (0, None))[0]:
+                best[wordId] = (score, defId)
+    Profiler.count("words with a positive score", len(best))
+
+    # Only decode the strings of the words that can make the top k
+    with Profiler.timer("sort"):
+        ranked = sorted(best.items(), key = lambda x : x[1][0], reverse=True)[:k]
+    return [ (corpus.words[wordId], score, corpus.definitions[defId])
+             for wordId, (score, defId) in ranked ]
+
+
+def use_cosine_metric(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Score every definition at once with TF-IDF cosine similarity. Without
+        a pattern this is a batch of one, so single and batch queries give
+        exactly the same results. """
+    corpus = prepare_corpus(corpus)
+    if not pattern:
+        with Profiler.timer("clean"):
+            hintTokens = tokenize_hint(wordHint)
+        return batch_cosine_metric(corpus, wordLen, [ hintTokens ], k)[0]
+
+    index = corpus.tfidf()
+    with Profiler.timer("clean"):
+        hintIds = corpus.encode(tokenize_hint(wordHint))
+    with Profiler.timer("score"):
+        scores = index.matrix.dot(index.query_vector(hintIds))
+    Profiler.count("definitions scored", len(corpus.definitions))
+
+    with Profiler.timer("filter"):
+        defIds = corpus.pattern_definitions(wordLen, pattern)
+        Profiler.count("definitions matching pattern", len(defIds))
+        defIds = defIds[scores[defIds] > 0]
+    Profiler.count("definitions with a positive score", len(defIds))
+    return rank_words(corpus, defIds, scores[defIds], k)
+
+
+def use_fused_metric(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Score a fused corpus: each word gets the weighted sum over sources of
+        its best definition score within that source, then one top k is taken
+        over the words of every source """
+    with Profiler.timer("clean"):
+        hintTokens = tokenize_hint(wordHint)
+    defIds, sourceScores = score_sources(corpus, wordLen, hintTokens, pattern)
+    Profiler.count("definitions with a positive score", len(defIds))
+    if len(defIds) == 0:
+        return []
+
+    with Profiler.timer("score"):
+        # Definition ids are sorted, so the definitions of each word are adjacent
+        wordIds = corpus.defWord[defIds]
+        _, starts = np.unique(wordIds, return_index=True)
+        combined = np.zeros(len(starts))
+        weighted = np.zeros(len(defIds))
+        for bit, name in enumerate(corpus.sourceNames):
+            weight = State.FUSED_WEIGHTS.get(name, 1.0)
+            combined += weight * np.maximum.reduceat(sourceScores[bit], starts)
+            weighted = np.maximum(weighted, weight * sourceScores[bit])
+
+    with Profiler.timer("sort"):
+        # Show each word with the definition contributing the most to its score
+        best = corpus.best_definitions(defIds, weighted)
+        ranked = sorted(( x for x in zip(best, combined.tolist()) if x[1] > 0 ),
+                        key = lambda x : x[1], reverse=True)[:k]
+    return [ (corpus.words[wordId], score, corpus.definitions[defId])
+             for (wordId, defId), score in ranked ]
+
+
+def use_graph_metric(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Walk the synonym graph up to State.GRAPH_HOPS edges out from every hint
+        token (and the whole hint, when it is a node). A node reached in n hops
+        gets GRAPH_DECAY ** (n - 1) from each token, and its score is the sum
+        over tokens divided by the number of hint tokens. """
+    corpus = prepare_corpus(corpus)
+    graph = corpus.synonym_graph()
+    with Profiler.timer("clean"):
+        hintTokens = sorted(tokenize_hint(wordHint))
+        seeds = [ (graph.node_ids([ t ]), 1) for t in hintTokens if t ]
+        phrase = phrase_key(wordHint)
+        if phrase and phrase not in hintTokens:
+            # A multi word synonym matching the whole hint, stopwords and all,
+            # counts for every token
+            seeds.append((graph.node_ids([ phrase ]), len(hintTokens)))
+        seeds = [ (int(ids[0]), weight) for ids, weight in seeds if len(ids) > 0 ]
+    if not seeds:
+        return []
+
+    with Profiler.timer("score"):
+        reached = [ graph.expand(seed, State.GRAPH_HOPS, State.GRAPH_DECAY) for seed, _ in seeds ]
+        nodeIds, inverse = np.unique(np.concatenate([ ids for ids, _ in reached ]), return_inverse=True)
+        weights = np.concatenate([ scores * weight for (_, scores), (_, weight) in zip(reached, seeds) ])
+        scores = np.bincount(inverse, weights=weights, minlength=len(nodeIds)) / len(hintTokens)
+    Profiler.count("graph nodes reached", len(nodeIds))
+
+    with Profiler.timer("filter"):
+        # Hint words themselves are never the answer
+        keep = (graph.nodeLens[nodeIds] == wordLen) & ~np.isin(nodeIds, [ seed for seed, _ in seeds ])
+        nodeIds, scores = nodeIds[keep], scores[keep]
+        if pattern:
+            letters = [ (i, c) for i, c in enumerate(pattern.lower()) if c not in CorpusIndex.UNKNOWN_LETTERS ]
+            match = np.array([ all( graph.compact[n][i] == c for i, c in letters ) for n in nodeIds.tolist() ],
+                             dtype=bool)
+            nodeIds, scores = nodeIds[match], scores[match]
+
+    # Best score first, ties in node order
+    with Profiler.timer("sort"):
+        order = np.lexsort((nodeIds, -scores))[:k]
+        possible = []
+        for nodeId, score in zip(nodeIds[order].tolist(), scores[order].tolist()):
+            via = [ graph.nodes[seed] for (seed, _), (ids, _) in zip(seeds, reached) if nodeId in ids ]
+            possible.append((graph.compact[nodeId], score, "related to " + ", ".join(via)))
     return possible
 
 
+def score_definitions(corpus, wordLen, hintTokens, pattern=None):
+    """ Score the definitions of words of length wordLen against the hint tokens
+        with the selected metric. Returns the sorted ids of the definitions with
+        a positive score and their scores. """
+    with Profiler.timer("filter"):
+        if pattern:
+            defIds = corpus.pattern_definitions(wordLen, pattern)
+        elif State.METRIC == State.Metric.JACCARD and State.APPROX:
+            defIds = corpus.minhash(State.APPROX_BANDS, State.APPROX_ROWS).candidates(wordLen, hintTokens)
+        elif State.METRIC == State.Metric.JACCARD:
+            defIds = corpus.candidates(wordLen, corpus.encode(hintTokens))
+        else:
+            defIds = corpus.length_rows(wordLen)
+        defIds = np.asarray(defIds, dtype=np.int64)
+    Profiler.count("definitions scored", len(defIds))
+
+    with Profiler.timer("score"):
+        if State.METRIC == State.Metric.JACCARD:
+            hintIds = corpus.encode(hintTokens)
+            scores = np.array([ jaccard_tokens(hintIds, corpus.tokens[d]) for d in defIds.tolist() ],
+                              dtype=np.float64)
+        elif State.METRIC == State.Metric.COSINE:
+            index = corpus.tfidf()
+            scores = index.matrix.dot(index.query_vector(corpus.encode(hintTokens)))[defIds]
+        elif State.METRIC == State.Metric.VECTOR:
+            index = corpus.sentences(get_word_vectors(), State.CACHE_DIRECTORY)
+            scores = np.asarray(index.matrix[defIds]).dot(average_sentence_vec(hintTokens))
+
+    keep = scores > 0
+    return defIds[keep], scores[keep]
+
+
+def score_sources(corpus, wordLen, hintTokens, pattern=None):
+    """ Score the definitions of a fused corpus within each of its sources.
+        Returns the sorted ids of the definitions with a positive score in
+        any source and, per source, their scores there (0 outside it). The
+        cosine metric weighs tokens with each source's own TF-IDF index, so
+        one source's definitions never change the scores of another's. """
+    if State.METRIC != State.Metric.COSINE:
+        defIds, scores = score_definitions(corpus, wordLen, hintTokens, pattern)
+        sources = corpus.defSources[defIds]
+        return defIds, [ np.where((sources >> bit) & 1 == 1, scores, 0.0)
+                         for bit in range(len(corpus.sourceNames)) ]
+
+    with Profiler.timer("filter"):
+        defIds = corpus.pattern_definitions(wordLen, pattern) if pattern else corpus.length_rows(wordLen)
+        defIds = np.asarray(defIds, dtype=np.int64)
+    Profiler.count("definitions scored", len(defIds))
+
+    with Profiler.timer("score"):
+        hintIds = corpus.encode(hintTokens)
+        scores = []
+        for bit in range(len(corpus.sourceNames)):
+            index = corpus.source_tfidf(bit)
+            scores.append(index.matrix.dot(index.query_vector(hintIds))[defIds])
+    keep = np.logical_or.reduce([ s > 0 for s in scores ]) if scores else np.zeros(len(defIds), dtype=bool)
+    return defIds[keep], [ s[keep] for s in scores ]
+
+
+def rank_words(corpus, defIds, scores, k=10):
+    """ Turn sorted definition ids and their scores into the top k
+        (word, score, matching definition) tuples, best definition per word """
+    with Profiler.timer("sort"):
+        best = corpus.best_definitions(defIds, scores)
+        bestScores = scores[np.searchsorted(defIds, [ defId for _, defId in best ])].tolist()
+
+        # Stable sort keeps word order among ties, like sorting a full scan
+        ranked = sorted(zip(best, bestScores), key = lambda x : x[1], reverse=True)[:k]
+    Profiler.count("words with a positive score", len(best))
+    return [ (corpus.words[wordId], score, corpus.definitions[defId])
+             for (wordId, defId), score in ranked ]
+
+
+def get_possible_words_batch(corpus, queries):
+    """ Construct lists of possible word matches for many (length, hint) queries
+        at once, giving the same lists as get_possible_words in query order.
+        Queries are grouped by answer length and each length bucket is scored
+        against all of its hints together. Queries may carry a third pattern
+        item; those are answered one at a time. """
+    if isinstance(corpus, CorpusIndex.ShardedCorpus):
+        # Answer each length from its own shard
+        results = [ None ] * len(queries)
+        byShard = {}
+        for i, query in enumerate(queries):
+            byShard.setdefault(query[0], []).append(i)
+        for wordLen, ids in byShard.items():
+            possibles = get_possible_words_batch(corpus.shard(wordLen), [ queries[i] for i in ids ])
+            for i, possible in zip(ids, possibles):
+                results[i] = possible
+        return results
+
+    cache = get_query_cache() if isinstance(corpus, CorpusIndex.PreparedCorpus) else None
+    corpus = prepare_corpus(corpus)
+    results = [ None ] * len(queries)
+
+    byLength = {}
+    for i, query in enumerate(queries):
+        if ((len(query) > 2 and query[2]) or (State.APPROX and State.METRIC == State.Metric.JACCARD)
+                or corpus.defSources is not None or State.METRIC == State.Metric.GRAPH):
+            results[i] = get_possible_words(corpus, *query)
+            continue
+        if cache is not None:
+            cached = cache.get(query_key(corpus, query[0], query[1]))
+            if cached is not None:
+                results[i] = list(cached)
+                continue
+        byLength.setdefault(query[0], []).append(i)
+
+    for wordLen, ids in byLength.items():
+        # Tokenize every hint exactly once
+        with Profiler.timer("clean"):
+            hints = [ tokenize_hint(queries[i][1]) for i in ids ]
+        for _ in ids:
+            Profiler.count("definitions of length", len(corpus.length_rows(wordLen)))
+
+        if State.METRIC == State.Metric.JACCARD:
+            possibles = batch_jaccard_metric(corpus, wordLen, hints)
+        elif State.METRIC == State.Metric.COSINE:
+            possibles = batch_cosine_metric(corpus, wordLen, hints)
+        elif State.METRIC == State.Metric.VECTOR:
+            possibles = batch_vector_metric(corpus, wordLen, hints)
+
+        for i, possible in zip(ids, possibles):
+            results[i] = possible
+            if cache is not None:
+                cache.put(query_key(corpus, wordLen, queries[i][1]), tuple(possible))
+
+    return results
+
+
+def batch_jaccard_metric(corpus, wordLen, hints, k=10):
+    """ Jaccard scores for many tokenized hints against one length bucket, using
+        a sparse hint x definition token overlap matrix """
+    from scipy import sparse
+    encoded = [ corpus.encode(h) for h in hints ]
+    rows, cols = [], []
+    for row, hintIds in enumerate(encoded):
+        for t in hintIds:
+            if t >= 0:
+                rows.append(row)
+                cols.append(t)
+    hintMatrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                   shape=(len(hints), len(corpus.vocab)))
+
+    defIds = corpus.length_rows(wordLen)
+    with Profiler.timer("filter"):
+        matrix = corpus.token_matrix(wordLen)
+    with Profiler.timer("score"):
+        defSizes = np.diff(corpus.tokens.starts)[defIds]
+        overlap = hintMatrix.dot(matrix.T).tocsr()
+        overlap.sort_indices()
+
+    possibles = []
+    for row, hintIds in enumerate(encoded):
+        span = slice(overlap.indptr[row], overlap.indptr[row + 1])
+        hits, inter = overlap.indices[span], overlap.data[span]
+        with Profiler.timer("score"):
+            scores = inter / (len(hintIds) + defSizes[hits] - inter)
+        Profiler.count("definitions scored", len(hits))
+        possibles.append(rank_words(corpus, defIds[hits], scores, k))
+    return possibles
+
+
+def batch_cosine_metric(corpus, wordLen, hints, k=10):
+    """ TF-IDF cosine scores for many tokenized hints against one length bucket
+        with a single sparse matrix product """
+    index = corpus.tfidf()
+    queryMatrix = index.query_matrix([ corpus.encode(h) for h in hints ])
+    with Profiler.timer("filter"):
+        matrix = index.length_matrix(wordLen)
+    with Profiler.timer("score"):
+        scores = queryMatrix.dot(matrix.T).tocsr()
+        scores.sort_indices()
+
+    defIds = corpus.length_rows(wordLen)
+    possibles = []
+    for row in range(len(hints)):
+        span = slice(scores.indptr[row], scores.indptr[row + 1])
+        hits, values = scores.indices[span], scores.data[span]
+        keep = values > 0
+        Profiler.count("definitions scored", len(defIds))
+        Profiler.count("definitions with a positive score", int(keep.sum()))
+        possibles.append(rank_words(corpus, defIds[hits[keep]], values[keep], k))
+    return possibles
+
+
+def batch_vector_metric(corpus, wordLen, hints, k=10):
+    """ Word vector cosine scores for many tokenized hints against one length
+        bucket, gathering its definition vectors once. Every hint gets its own
+        matrix-vector product, since float32 rounding of a matrix product can
+        differ by batch size. """
+    index = corpus.sentences(get_word_vectors(), State.CACHE_DIRECTORY)
+    defIds = corpus.length_rows(wordLen)
+    rows = np.asarray(index.matrix[defIds])
+
+    possibles = []
+    for hintTokens in hints:
+        with Profiler.timer("score"):
+            scores = rows.dot(average_sentence_vec(hintTokens))
+            keep = scores > 0
+        Profiler.count("definitions scored", len(defIds))
+        Profiler.count("definitions with a positive score", int(keep.sum()))
+        possibles.append(rank_words(corpus, defIds[keep], scores[keep], k))
+    return possibles
+
+
 def jaccard(query1, query2):
     """ Calculate the jaccard value between two inputs """
-    q1 = set(clean_string(query1).split(" "))
-    q2 = set(clean_string(query2).split(" "))
+    return jaccard_tokens(tokenize(query1), tokenize(query2))
+
+
+def jaccard_tokens(q1, q2):
+    """ Calculate the jaccard value between two already tokenized inputs """
+    inter = len(q1 & q2)
+    return inter / (len(q1) + len(q2) - inter)
+
 
-    return len(q1.intersection(q2)) / len(q1.union(q2))
+def use_vector_metric(corpus, wordLen, wordHint, pattern=None, k=10):
+    """ Score definitions by cosine similarity of averaged word vectors.
+        Without a pattern this is a batch of one, so single and batch queries
+        give exactly the same results. """
+    corpus = prepare_corpus(corpus)
+    if not pattern:
+        with Profiler.timer("clean"):
+            hintTokens = tokenize_hint(wordHint)
+        return batch_vector_metric(corpus, wordLen, [ hintTokens ], k)[0]
+
+    index = corpus.sentences(get_word_vectors(), State.CACHE_DIRECTORY)
+    with Profiler.timer("clean"):
+        query = average_sentence_vec(tokenize_hint(wordHint))
+    with Profiler.timer("filter"):
+        defIds = corpus.pattern_definitions(wordLen, pattern)
+    Profiler.count("definitions scored", len(defIds))
+
+    with Profiler.timer("score"):
+        # One dot product over only the rows matching the pattern
+        scores = np.asarray(index.matrix[defIds]).dot(query)
+        keep = scores > 0
+    return rank_words(corpus, defIds[keep], scores[keep], k)
+
+
+def get_word_vectors():
+    """ Load the local word vectors file on first use """
+    global wordVectors
+    if wordVectors is None:
+        wordVectors = VectorStore.WordVectors(State.VECTORS_FILE, State.CACHE_DIRECTORY)
+    return wordVectors
 
 
 def average_sentence_vec(words):
-    """  """
-    # TODO: calc sentence feature vector
-    return ""
+    """ Calculate the unit length average word vector of the given tokens """
+    return get_word_vectors().average(words)
+
+
+def sample_clues(golden, rng=random):
+    """ Randomly sample State.SAMPLES golden answers and one clue for each """
+    sampleWords = rng.sample(list(golden.keys()), State.SAMPLES)
+    if State.DEBUG:
+        print("[DEBUG] Using sample words:" , sampleWords)
 
+    return [ (answer, rng.choice(golden[answer])) for answer in sampleWords ]
 
-def evaluate_corpus(corpus, golden):
-    """ Evaluate the given corpus against given golden standard """
+
+def score_clue_batch(clues):
+    """ Pool worker: get possible words for a chunk of (answer, clue) pairs using
+        the corpus inherited from the parent process """
+    return get_possible_words_batch(evalCorpus, [ (len(answer), clue) for answer, clue in clues ])
+
+
+def score_clues(corpus, clues, pool=None):
+    """ Get possible words for every (answer, clue) pair, in order """
+    if pool is None:
+        return get_possible_words_batch(corpus, [ (len(answer), clue) for answer, clue in clues ])
+
+    size = max(1, -(-len(clues) // (4 * State.WORKERS)))
+    chunks = [ clues[i:i + size] for i in range(0, len(clues), size) ]
+    return [ possible for chunk in pool.map(score_clue_batch, chunks) for possible in chunk ]
+
+
+def start_pool(corpus):
+    """ Start a process pool of State.WORKERS workers sharing the prepared corpus
+        copy-on-write, or return None when running serially """
+    global evalCorpus
+    if State.WORKERS <= 1:
+        return None
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print(State.LABEL, "--workers NEEDS fork SUPPORT, EVALUATING SERIALLY")
+        return None
+
+    # Prepare before forking so every worker inherits the same indexes
+    evalCorpus = prepare_corpus(corpus)
+    return multiprocessing.get_context("fork").Pool(State.WORKERS)
+
+
+def evaluate_corpus(corpus, golden, rng=random, clues=None, possible=None):
+    """ Evaluate the given corpus against given golden standard. Clues and their
+        possible words can be passed in when they were sampled and scored ahead """
     withinCorrectWords = []
     withinIncorrectWords = []
     withoutNum = 0
 
     # Randomly sample golden corpus
-    sampleWords = random.sample(golden.keys(), State.SAMPLES)
-    if State.DEBUG:
-        print("[DEBUG] Using sample words:" , sampleWords)
-
-    for answer in sampleWords:
-        clue = random.choice(golden[answer])
-        possibleWords = get_possible_words(corpus, len(answer), clue)
+    if clues is None:
+        clues = sample_clues(golden, rng)
+    if possible is None:
+        possible = score_clues(corpus, clues)
 
+    for (answer, clue), possibleWords in zip(clues, possible):
         # Check if possible words contains correct answer
         check = list(filter( lambda x : x[0] == answer , possibleWords ))
         if len(check) > 0:
@@ -118,12 +793,27 @@ def evaluate_corpus(corpus, golden):
 
 def run_evaluation(corpus, golden):
     """ Generate tables containing evaluation data """
+    from terminaltables import AsciiTable
     wordsTable, correctTable, statsTable = None, None, None
 
+    # Sample every loop up front from its own seed, then score all clues at
+    # once so serial and parallel runs produce identical results
+    seed = State.SEED if State.SEED is not None else random.randrange(2 ** 32)
+    print(State.LABEL, "EVALUATING WITH SEED", seed)
+    loopClues = [ sample_clues(golden, random.Random(seed + i)) for i in range(State.LOOPS) ]
+
+    pool = start_pool(corpus)
+    try:
+        possible = score_clues(corpus, [ c for clues in loopClues for c in clues ], pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     results = []
-    
-    for i in range(State.LOOPS):
-        results.append(evaluate_corpus(corpus, golden))
+    for i, clues in enumerate(loopClues):
+        loopPossible = possible[i * State.SAMPLES:(i + 1) * State.SAMPLES]
+        results.append(evaluate_corpus(corpus, golden, clues=clues, possible=loopPossible))
     
     if State.DEBUG:
         # TODO: format this output with labels and a table?
@@ -140,37 +830,39 @@ def run_evaluation(corpus, golden):
              "\n".join(evalResult["withinIncor"]),
              evalResult["withoutN"])
         )
-        wordsTable = AsciiTable(WORDS_DATA, "Word Results")
-        # Only output word result tables if NOT looping --minimize output
-        if State.DEBUG or State.LOOPS == 1:
-            print("\n" + wordsTable.table)
+        with Profiler.timer("render"):
+            wordsTable = AsciiTable(WORDS_DATA, "Word Results")
+            # Only output word result tables if NOT looping --minimize output
+            if State.DEBUG or State.LOOPS == 1:
+                print("\n" + wordsTable.table)
  
-        MATCH_DATA = ("Word" , "Jaccard Value" , "Matching Corpus Value" , "Hint", "Max Jaccard Value", "Jaccard Distance")
-        data = []
-        correctTable = AsciiTable([MATCH_DATA, []])
-
-        # Cap column widths at 35 chars for widest columns
-        maxValWidth = min(correctTable.column_max_width(2), 35)
-        maxHintWidth = min(correctTable.column_max_width(3), 35)
+            MATCH_DATA = ("Word" , "Jaccard Value" , "Matching Corpus Value" , "Hint", "Max Jaccard Value", "Jaccard Distance")
+            data = []
+            correctTable = AsciiTable([MATCH_DATA, []])
+
+            # Cap column widths at 35 chars for widest columns, and keep at least
+            # 10 chars when there is no terminal to measure (e.g. output is piped)
+            maxValWidth = max(10, min(correctTable.column_max_width(2), 35))
+            maxHintWidth = max(10, min(correctTable.column_max_width(3), 35))
         
-        for i in range(len(evalResult["withinCor"])):
-            r = list(evalResult["withinCor"][i])
+            for i in range(len(evalResult["withinCor"])):
+                r = list(evalResult["withinCor"][i])
 
-            # Format text to wrap
-            wrappedVal = '\n'.join(wrap(r[2], maxValWidth))
-            wrappedHint = '\n'.join(wrap(r[3], maxHintWidth))
-            r[2] = wrappedVal
-            r[3] = wrappedHint
+                # Format text to wrap
+                wrappedVal = '\n'.join(wrap(r[2], maxValWidth))
+                wrappedHint = '\n'.join(wrap(r[3], maxHintWidth))
+                r[2] = wrappedVal
+                r[3] = wrappedHint
 
-            if State.DEBUG:
-                print(r)
+                if State.DEBUG:
+                    print(r)
 
-            data.append(r)
+                data.append(r)
 
-        correctTable = AsciiTable(tuple([MATCH_DATA] + data), "Correct Matches Results")
-        # Only output word result tables if NOT looping --minimize output
-        if State.DEBUG or State.LOOPS == 1:
-            print("\n" + correctTable.table)
+            correctTable = AsciiTable(tuple([MATCH_DATA] + data), "Correct Matches Results")
+            # Only output word result tables if NOT looping --minimize output
+            if State.DEBUG or State.LOOPS == 1:
+                print("\n" + correctTable.table)
 
         # Check if we had any hits at all, otherwise output zeroes
         if (State.SAMPLES != evalResult["withoutN"]):
@@ -196,5 +888,135 @@ def run_evaluation(corpus, golden):
          distances / totalWithinCor if totalWithinCor > 0 else 0.0)
     )
 
-    statsTable = AsciiTable(STATS_DATA, "Statistics")
-    print("\n" + statsTable.table)
+    with Profiler.timer("render"):
+        statsTable = AsciiTable(STATS_DATA, "Statistics")
+        print("\n" + statsTable.table)
+
+    if (State.DEBUG or State.PROFILE) and get_query_cache() is not None:
+        print(State.LABEL, "QUERY CACHE {hits} HITS, {misses} MISSES ({hit_rate:.1%} HIT RATE)".format(
+            **get_query_cache().stats()))
+
+
+def eval_keys(corpus, lengths):
+    """ Key of everything a clue of each given answer length is scored against:
+        the metric, its settings and the words of that length with their
+        definitions. TF-IDF weights and synonym graph paths span the whole
+        corpus, so with those metrics every length depends on every other. """
+    fingerprints = { wordLen : corpus.length_fingerprint(wordLen) for wordLen in lengths }
+    if State.METRIC in (State.Metric.COSINE, State.Metric.GRAPH):
+        whole = "".join( corpus.length_fingerprint(wordLen) for wordLen in sorted(corpus.lengthWords) )
+        fingerprints = { wordLen : whole for wordLen in lengths }
+
+    settings = repr((State.METRIC.name, query_settings(corpus))).encode("utf-8")
+    return { wordLen : hashlib.blake2b(settings + fp.encode("utf-8"), digest_size=16).hexdigest()
+             for wordLen, fp in fingerprints.items() }
+
+
+def clue_record(corpus, answer, clue, key, possibleWords):
+    """ Result of one clue: the rank of its answer among the possible words
+        (0 when missing), its score and the best score """
+    words = [ w[0] for w in possibleWords ]
+    rank = words.index(answer) + 1 if answer in words else 0
+    return {"answer" : answer, "clue" : clue, "key" : key, "rank" : rank,
+            "within" : rank > 0 or answer in corpus,
+            "score" : float(possibleWords[rank - 1][1]) if rank else 0.0,
+            "top" : float(possibleWords[0][1]) if possibleWords else 0.0}
+
+
+def run_full_evaluation(corpus, golden):
+    """ Score every (answer, clue) pair of the golden corpus and report recall@k,
+        MRR and the within percentages. Results are saved per clue, so later
+        runs only score clues whose answer length bucket changed. """
+    from terminaltables import AsciiTable
+    corpus = prepare_corpus(corpus)
+    clues = [ (answer, clue) for answer, values in golden.items() for clue in values ]
+    keys = eval_keys(corpus, set( len(answer) for answer, _ in clues ))
+
+    store = EvalStore.EvalStore(EvalStore.results_file())
+    todo = list(dict.fromkeys( c for c in clues if store.get(c[0], c[1], keys[len(c[0])]) is None ))
+    print(State.LABEL, "EVALUATING {} CLUES, {} TO SCORE".format(len(clues), len(todo)), flush=True)
+
+    start = time.perf_counter()
+    pool = start_pool(corpus) if todo else None
+    try:
+        for first in range(0, len(todo), EVAL_CHUNK):
+            chunk = todo[first:first + EVAL_CHUNK]
+            possible = score_clues(corpus, chunk, pool)
+            store.add([ clue_record(corpus, answer, clue, keys[len(answer)], possibleWords)
+                        for (answer, clue), possibleWords in zip(chunk, possible) ])
+
+            done = first + len(chunk)
+            print(State.LABEL, "SCORED {}/{} CLUES ({:.0f} CLUES/S)".format(
+                done, len(todo), done / (time.perf_counter() - start)), flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    store.save(clues)
+
+    # Rank arrays over every clue; recall and MRR count clues whose answer is in the corpus
+    records = [ store.results[c] for c in clues ]
+    ranks = np.array([ r["rank"] for r in records ], dtype=np.int64)
+    within = np.array([ r["within"] for r in records ], dtype=bool)
+    distances = np.array([ r["top"] - r["score"] for r in records if r["rank"] ])
+    withinN = max(int(within.sum()), 1)
+    found = ranks > 0
+
+    def recall(k):
+        return int((found & (ranks <= k)).sum()) / withinN
+
+    STATS_DATA = (
+        ("Clues", "Percentage Within", "Within Incorrect", "Recall@1", "Recall@5", "Recall@10", "MRR",
+         "Average Jaccard Distance"),
+        (len(clues),
+         within.sum() / max(len(clues), 1),
+         int((within & ~found).sum()) / withinN,
+         recall(1), recall(5), recall(10),
+         (1.0 / ranks[found]).sum() / withinN,
+         distances.mean() if len(distances) > 0 else 0.0)
+    )
+
+    with Profiler.timer("render"):
+        statsTable = AsciiTable(STATS_DATA, "Full Evaluation")
+        print("\n" + statsTable.table)
+    print(State.LABEL, "SAVED PER-CLUE RESULTS TO", store.filename)
+
+
+def run_approx_recall(corpus, golden):
+    """ Compare approximate against exact jaccard results on sampled golden clues """
+    from terminaltables import AsciiTable
+    corpus = prepare_corpus(corpus)
+    corpus.minhash(State.APPROX_BANDS, State.APPROX_ROWS)
+    approx = State.APPROX
+    found, expected = 0, 0
+    exactTime, approxTime = 0.0, 0.0
+
+    for answer in random.sample(list(golden.keys()), State.SAMPLES):
+        clue = random.choice(golden[answer])
+
+        State.APPROX = False
+        start = time.perf_counter()
+        exactWords = set( w[0] for w in get_possible_words(corpus, len(answer), clue) )
+        exactTime += time.perf_counter() - start
+
+        State.APPROX = True
+        start = time.perf_counter()
+        approxWords = set( w[0] for w in get_possible_words(corpus, len(answer), clue) )
+        approxTime += time.perf_counter() - start
+
+        found += len(exactWords & approxWords)
+        expected += len(exactWords)
+
+    State.APPROX = approx
+
+    RECALL_DATA = (
+        ("Bands", "Rows Per Band", "Recall Of Exact Top 10", "Exact ms/query", "Approximate ms/query"),
+        (State.APPROX_BANDS,
+         State.APPROX_ROWS,
+         found / expected if expected > 0 else 1.0,
+         1000 * exactTime / State.SAMPLES,
+         1000 * approxTime / State.SAMPLES)
+    )
+
+    recallTable = AsciiTable(RECALL_DATA, "Approximate Recall")
+    print("\n" + recallTable.table)
@@ -0,0 +1,63 @@
+'''
+EvalStore: module for saving per-clue evaluation results between --eval all runs
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import json, os
+
+import State, CorpusLog
+
+## CLASSES ##
+class EvalStore:
+    """ Per-clue results of evaluating one corpus with one metric, kept in a
+        JSONL file. Every record carries the key of what its clue was scored
+        against, and is only reused while that key is unchanged. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.results = {}       # (answer, clue) -> latest record
+        for record in read(filename):
+            self.results[(record["answer"], record["clue"])] = record
+
+    def get(self, answer, clue, key):
+        """ Return the saved record of a clue if it was scored under key, else None """
+        record = self.results.get((answer, clue))
+        return record if record is not None and record["key"] == key else None
+
+    def add(self, records):
+        """ Remember new records and append them to the file right away, so an
+            interrupted run keeps what it already scored """
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename, "a") as f:
+            f.write(CorpusLog.complete_line_prefix(f))
+            for record in records:
+                self.results[(record["answer"], record["clue"])] = record
+                f.write(json.dumps(record) + "\n")
+
+    def save(self, clues):
+        """ Rewrite the file with just the latest record of each given clue """
+        CorpusLog.write_atomic(self.filename, "".join( json.dumps(self.results[c]) + "\n"
+                                                       for c in dict.fromkeys(clues) if c in self.results ))
+
+
+## MODULE FUNCTIONS ##
+def results_file():
+    """ Path of the saved results of the selected corpus and metric """
+    name = "eval_{}_{}.jsonl".format(State.CORPORA.name, State.METRIC.name).lower()
+    return os.path.join(State.CACHE_DIRECTORY, name)
+
+
+def read(filename):
+    """ Yield the records of a results file, skipping a partially written one """
+    try:
+        f = open(filename, "r")
+    except OSError:
+        return
+    with f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
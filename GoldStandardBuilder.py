@@ -5,19 +5,25 @@ Alex Berg and Nikki Kyllonen
 """
 
 import json
+import os
+import queue
 import re
-import requests
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import CorpusBuilder
+import CorpusLog
+import HttpCache
 
-# Website with clues and answers
-SOLVER_BASE_URL = "https://www.crosswordsolver.org"
+
+# Website with clues and answers (can be overridden, e.g. to point at a local fixture server)
+SOLVER_BASE_URL = os.environ.get("CROSSWORD_SOLVER_BASE_URL", "https://www.crosswordsolver.org")
 
 # File paths
 DATA_DIRECTORY = "./data/"
 ANSWER_CLUE_DATA_FILE_NAME = "answer_clue_data.json"
+CHECKPOINT_FILE_NAME = "answer_clue_checkpoint.jsonl"  # one scraped pair per line, removed when done
 
-# List of (answer, clue) tuples (will be modified)
+# List of (answer, clue) tuples (will be modified, only by the main thread)
 answer_clue_pairs = []
 
 
@@ -26,30 +32,69 @@ answer_clue_pairs = []
 def build_gold_standard():
     """Build a JSON mapping words to a list of their definitions and save it to a file.
        Do this for clues starting with each letter in the alphabet for a specified number
-       per letter. Also specify the number of threads to use when getting the answers
-       for each clue."""
+       per letter. Also specify the number of threads to use when getting the answers.
+       Every scraped pair is checkpointed, so an interrupted run resumes where it stopped."""
     clue_letters = "abcdefghijklmnopqrstuvwxyz"  # letters for the start of the clues
     num_clues_per_letter = 90  # number of clues to get per letter
-    num_threads = 16  # num threads to use when getting the answers during each letter (letters are done sequentially)
-
-    for letter in clue_letters:
-        print("On letter " + letter)
-        get_answer_clue_pairs_for_letter(letter, num_clues_per_letter, num_threads)
+    num_threads = 16  # size of the worker pool shared by all letters
+    checkpoint_file = DATA_DIRECTORY + CHECKPOINT_FILE_NAME
+
+    done_urls = load_checkpoint(checkpoint_file)
+    if done_urls:
+        print("Resuming with {0} pairs from {1}".format(len(done_urls), checkpoint_file))
+
+    import requests  # deferred so ACVC.py startup does not pay for it
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    results = queue.Queue()  # (url, answer, clue) tuples from the workers
+    with session, ThreadPoolExecutor(num_threads) as executor:
+        # Get the clue lists of all letters concurrently, then queue every answer lookup
+        letter_pairs = executor.map(lambda letter: get_clue_url_pairs_for_letter(letter, session),
+                                    clue_letters)
+        num_jobs = 0
+        for letter, pairs in zip(clue_letters, letter_pairs):
+            for clue, url in select_pairs(pairs, num_clues_per_letter):
+                if url not in done_urls:
+                    executor.submit(add_answer_clue_pair, clue, url, results, session)
+                    num_jobs += 1
+        print("Getting {0} answers".format(num_jobs))
+
+        # Only this thread touches the pairs list and the checkpoint file
+        with open(checkpoint_file, "a") as checkpoint:
+            for i in range(num_jobs):
+                url, answer, clue = results.get()
+                if answer is not None:
+                    answer_clue_pairs.append((answer, clue))
+                    checkpoint.write(json.dumps({"url": url, "answer": answer, "clue": clue}) + "\n")
+                    checkpoint.flush()
+                if (i + 1) % 100 == 0:
+                    print("Got {0}/{1} answers".format(i + 1, num_jobs))
+
+    # Append only the new pairs to the corpus log (merged into the corpus by compaction)
     dictionary = build_dictionary()
-    write_data_to_data_file(DATA_DIRECTORY + ANSWER_CLUE_DATA_FILE_NAME, json.dumps(dictionary))
+    CorpusLog.append(DATA_DIRECTORY + ANSWER_CLUE_DATA_FILE_NAME, dictionary, CorpusLog.ADD)
+    os.remove(checkpoint_file)
 
 
 # Helper functions
 
-def get_clue_url_pairs_for_letter(letter):
+def get_clue_url_pairs_for_letter(letter, session=None):
     """Returns a list of tuples with a clue and url to the site with the answer."""
-    # Get HTML of site with table of clues
+    # Get HTML of site with table of clues (from the on-disk cache when possible)
     url = SOLVER_BASE_URL + "/clues/" + letter
-    html_data = requests.get(url)
+    try:
+        html_data = HttpCache.get_text(url, session)
+    except Exception as ex:
+        print("Exception of type " + str(type(ex)))
+        print("Problem with url " + url)
+        return []
 
     # Pull out HTML segments with clues and link to answer
     pattern = r"<a href=\"/clues/{}/.*?</a>".format(letter)
-    html_clues = re.findall(pattern, html_data.text)
+    html_clues = re.findall(pattern, html_data)
 
     # Build a list of (clue, answer url) tuples
     pairs = []
@@ -61,10 +106,18 @@ def get_clue_url_pairs_for_letter(letter):
     return pairs
 
 
-def get_answer(url):
+def select_pairs(pairs, num_pairs):
+    """Returns num_pairs (clue, url) tuples spread evenly over the given pairs."""
+    num_pairs = min(num_pairs, len(pairs))  # we cannot get more pairs than there are
+    if num_pairs == 0:
+        return []
+    return pairs[::len(pairs) // num_pairs]
+
+
+def get_answer(url, session=None):
     """Returns the answer to a clue from the url (from www.crosswordsolver.org)."""
     try:
-        html_data = requests.get(url)  # get the site HTML
+        html_data = HttpCache.get_text(url, session)  # get the site HTML (from the on-disk cache when possible)
     except Exception as ex:
         print("Exception of type " + str(type(ex)))
         print("Problem with url " + url)
@@ -72,46 +125,53 @@ def get_answer(url):
 
     # Extract the word from the HTML fragment and return it
     pattern = r"<div class='word'>.*?</div>"
-    answer = re.search(pattern, html_data.text).group(0)[18:-6]
+    match = re.search(pattern, html_data)
+    if match is None:
+        print("No answer found at url " + url)
+        return None
+    answer = match.group(0)[18:-6]
     return answer.lower()
 
 
-def add_answer_clue_pair(clue, url):
-    """Add an (answer, clue) pair to the global list of such pairs."""
-    global answer_clue_pairs
-    answer = get_answer(url)
-    if answer is not None:
-        answer_clue_pairs.append((answer, clue))
+def add_answer_clue_pair(clue, url, results, session=None):
+    """Worker: get the answer for a clue and put a (url, answer, clue) tuple on the results
+       queue. The answer is None if it could not be found."""
+    answer = None
+    try:
+        answer = get_answer(url, session)
+    finally:
+        results.put((url, answer, clue))  # always put, the main thread waits for every job
 
 
-def get_answer_clue_pairs_for_letter(letter, num_pairs=10, num_threads=2):
-    """For a given letter, add num_pairs number of (answer, clue) pairs to the global list
-       of such pairs. Do this with num_threads number of threads."""
-    pairs = get_clue_url_pairs_for_letter(letter)
-    total_num_pairs = len(pairs)
+def load_checkpoint(filename):
+    """Add the pairs saved by an interrupted run to the global list of pairs and return
+       the set of urls they came from."""
+    done_urls = set()
+    try:
+        with open(filename, "r") as f:
+            data = f.read()
+    except OSError:  # no checkpoint, start from scratch
+        return done_urls
 
-    num_pairs = min(num_pairs, total_num_pairs)  # we cannot get more pairs than there are
+    for line in data.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:  # last line may be partial if the run was killed mid-write
+            continue
+        answer_clue_pairs.append((record["answer"], record["clue"]))
+        done_urls.add(record["url"])
 
-    i = 0  # index we are on
-    while i < total_num_pairs:
-        threads = []
-        threads_used = 0
-        while threads_used < num_threads and i < total_num_pairs:
-            clue, url = pairs[i]
-            threads.append(threading.Thread(target=add_answer_clue_pair, args=(clue, url)))
-            num_threads += 1
-            i += total_num_pairs // num_pairs
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+    if data and not data.endswith("\n"):  # start new records on a fresh line
+        with open(filename, "a") as f:
+            f.write("\n")
+    return done_urls
 
 
 def build_dictionary():
     """Build a dictionary of words to a list of clues that had them as the answer. The
-       words and clues come from the global list of pairs."""
-    # Get existing answers and clues
-    dictionary = load_data_from_data_file(DATA_DIRECTORY + ANSWER_CLUE_DATA_FILE_NAME)
+       words and clues come from the global list of pairs (existing data is not loaded,
+       the log compaction merges the two)."""
+    dictionary = {}
 
     # Add new answers and clues to data
     for answer, clue in answer_clue_pairs:
@@ -123,20 +183,12 @@ def build_dictionary():
     return dictionary
 
 
-def load_data_from_data_file(filename):
-    """Read JSON data from file. If the file is empty or does not exist, load an
-       empty JSON."""
-    try:
-        with open(filename, "r") as f:
-            data = f.read()
-        if data == "":  # check if file was empty or nonexistent
-            data = "{}"
-    except OSError:  # file could not be opened (possibly does not exist)
-        data = "{}"
-    return json.loads(data)
+def load_data_from_data_file(filename, lengths=None):
+    """Read JSON data from file with the streaming loader. If the file is empty or does
+       not exist, load an empty JSON."""
+    return CorpusBuilder.load_data_from_data_file(filename, lengths)
 
 
 def write_data_to_data_file(filename, data):
-    """Write data to file."""
-    with open(filename, "w") as f:
-        f.write(data)
+    """Write data to file, replacing it atomically so a crash cannot leave it half written."""
+    CorpusLog.write_atomic(filename, data)
@@ -0,0 +1,262 @@
+'''
+GridSolver: module for filling a whole crossword grid from its clues
+
+A grid spec is a JSON file with the rows of the grid (# for blocks, _ or . for
+unknown letters, letters for known ones) and the clues by number:
+
+    {"grid"   : ["#___", "____", "____", "___#"],
+     "across" : {"1" : "clue", "4" : "clue", ...},
+     "down"   : {"1" : "clue", "2" : "clue", ...}}
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import json, time
+
+import numpy as np
+
+import State, CorpusIndex, DecisionMaker
+
+## GLOBAL VARIABLES ##
+BLOCK = "#"
+MAX_STEPS = 100000  # candidate assignments tried before the search gives up
+
+
+## CLASSES ##
+class Slot:
+    """ One across or down entry of a grid along with its candidate words. A set
+        of candidates is a bitset where bit i stands for the i-th candidate,
+        best scoring first. """
+
+    def __init__(self, number, direction, cells):
+        self.number = number
+        self.direction = direction
+        self.cells = cells          # (row, column) of every letter
+        self.clue = None
+        self.words = []
+        self.scores = []
+        self.letters = []           # position -> letter -> bitset of candidates
+        self.crossings = []         # (position, other slot, position in the other slot)
+
+    @property
+    def name(self):
+        return "{}{}".format(self.number, self.direction[0].upper())
+
+    def set_candidates(self, possible):
+        """ Keep the (word, score, definition) candidates and index their
+            letters by position """
+        self.words = [ w.lower() for w, _, _ in possible ]
+        self.scores = [ float(s) for _, s, _ in possible ]
+        self.letters = []
+        for pos in range(len(self.cells)):
+            bits = {}
+            for bit, word in enumerate(self.words):
+                bits.setdefault(word[pos], []).append(bit)
+            self.letters.append({ letter : CorpusIndex.to_bitset(b, len(self.words))
+                                  for letter, b in bits.items() })
+
+    def all_candidates(self):
+        return (1 << len(self.words)) - 1
+
+
+class Grid:
+    """ A crossword grid numbered the usual way, with its slots and the
+        crossings between across and down slots """
+
+    def __init__(self, rows, across, down):
+        self.rows = [ row.lower().replace(".", "_") for row in rows ]
+        if len(set( len(row) for row in self.rows )) > 1:
+            raise ValueError("every grid row must have the same length")
+        self.slots = number_grid(self.rows)
+
+        clues = {"across" : across, "down" : down}
+        for slot in self.slots:
+            slot.clue = clues[slot.direction].get(str(slot.number))
+            if not slot.clue:
+                raise ValueError("no clue for slot " + slot.name)
+
+        # Link every pair of slots sharing a cell
+        cellSlots = {}
+        for slot in self.slots:
+            for pos, cell in enumerate(slot.cells):
+                cellSlots.setdefault(cell, []).append((slot, pos))
+        for shared in cellSlots.values():
+            if len(shared) == 2:
+                (a, i), (b, j) = shared
+                a.crossings.append((i, b, j))
+                b.crossings.append((j, a, i))
+
+    def pattern(self, slot):
+        """ Known letters of a slot, _ for unknown ones """
+        return "".join( self.rows[r][c] for r, c in slot.cells )
+
+    def filled(self, solution):
+        """ Rows of the grid with the words of a solution written in """
+        cells = [ list(row) for row in self.rows ]
+        for slot, word in solution.items():
+            for (r, c), letter in zip(slot.cells, word):
+                cells[r][c] = letter
+        return [ "".join(row).upper() for row in cells ]
+
+
+## HELPER FUNCTIONS ##
+def number_grid(rows):
+    """ Slots of a grid: a white cell starting a run of at least two white cells
+        across or down gets the next number """
+    def white(r, c):
+        return 0 <= r < len(rows) and 0 <= c < len(rows[r]) and rows[r][c] != BLOCK
+
+    slots, number = [], 0
+    for r in range(len(rows)):
+        for c in range(len(rows[r])):
+            if not white(r, c):
+                continue
+            across = not white(r, c - 1) and white(r, c + 1)
+            down = not white(r - 1, c) and white(r + 1, c)
+            if across or down:
+                number += 1
+            if across:
+                end = c
+                while white(r, end):
+                    end += 1
+                slots.append(Slot(number, "across", [ (r, x) for x in range(c, end) ]))
+            if down:
+                end = r
+                while white(end, c):
+                    end += 1
+                slots.append(Slot(number, "down", [ (y, c) for y in range(r, end) ]))
+    return slots
+
+
+def count_bits(bits):
+    return bin(bits).count("1")
+
+
+def lowest_bits(bits):
+    """ Positions of the set bits of a bitset, lowest (best candidate) first """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def revise(domains, slot, pos, other, otherPos):
+    """ Candidates of slot whose letter at pos is still possible at otherPos of
+        the other slot's remaining candidates """
+    allowed = 0
+    for letter, bits in other.letters[otherPos].items():
+        if bits & domains[other]:
+            allowed |= slot.letters[pos].get(letter, 0)
+    return domains[slot] & allowed
+
+
+def propagate(domains, queue):
+    """ Arc consistency (AC-3) over the crossings, starting from the slots in
+        queue whose candidates changed. Narrows domains in place and returns
+        False when some slot has no candidate left. """
+    queue = list(queue)
+    while queue:
+        changed = queue.pop()
+        for otherPos, slot, pos in changed.crossings:
+            narrowed = revise(domains, slot, pos, changed, otherPos)
+            if narrowed != domains[slot]:
+                if not narrowed:
+                    return False
+                domains[slot] = narrowed
+                queue.append(slot)
+    return True
+
+
+def search(grid, domains, steps):
+    """ Backtracking search over the slot with the fewest candidates left,
+        trying its candidates best score first and propagating every choice.
+        Returns a slot -> bit solution or None. """
+    open_ = [ s for s in grid.slots if domains[s] & (domains[s] - 1) ]
+    if not open_:
+        solution = { s : domains[s].bit_length() - 1 for s in grid.slots }
+        words = [ s.words[bit] for s, bit in solution.items() ]
+        return solution if len(set(words)) == len(words) else None
+
+    slot = min(open_, key = lambda s : count_bits(domains[s]))
+    used = set( s.words[domains[s].bit_length() - 1] for s in grid.slots if s not in open_ )
+    for bit in lowest_bits(domains[slot]):
+        if slot.words[bit] in used:
+            continue
+        steps[0] += 1
+        if steps[0] > MAX_STEPS:
+            return None
+        trial = dict(domains)
+        trial[slot] = 1 << bit
+        if propagate(trial, [ slot ]):
+            solution = search(grid, trial, steps)
+            if solution is not None:
+                return solution
+    return None
+
+
+## MODULE FUNCTIONS ##
+def load_grid(filename):
+    """ Read a grid spec JSON file """
+    with open(filename, "r") as f:
+        spec = json.load(f)
+    return Grid(spec["grid"], spec.get("across", {}), spec.get("down", {}))
+
+
+def generate_candidates(corpus, grid):
+    """ Candidate words of every slot from its clue and known letters. A slot
+        whose clue matches fewer than State.GRID_CANDIDATES words is padded
+        with the other words of its length, unscored, so the crossing letters
+        can still fill it. """
+    for slot in grid.slots:
+        pattern = grid.pattern(slot)
+        possible = DecisionMaker.get_possible_words(corpus, len(slot.cells), slot.clue,
+                                                    pattern if pattern.strip("_") else None,
+                                                    State.GRID_CANDIDATES)
+        if len(possible) < State.GRID_CANDIDATES:
+            words = CorpusIndex.length_corpus(corpus, len(slot.cells))
+            seen = set( w.lower() for w, _, _ in possible )
+            for wordId in np.asarray(words.lengthWords.get(len(slot.cells), [])).tolist():
+                word = words.words[wordId].lower()
+                if word not in seen and all( p == "_" or p == l for p, l in zip(pattern, word) ):
+                    seen.add(word)
+                    possible.append((word, 0.0, words.definitions[int(words.wordStart[wordId])]))
+        slot.set_candidates(possible)
+
+
+def solve(corpus, grid):
+    """ Fill the grid: generate candidates, prune them with arc consistency and
+        search the rest. Returns (slot -> word solution or None, slot ->
+        number of candidates after pruning). """
+    generate_candidates(corpus, grid)
+    domains = { s : s.all_candidates() for s in grid.slots }
+    consistent = all( domains.values() ) and propagate(domains, grid.slots)
+    pruned = { s : count_bits(domains[s]) if consistent else 0 for s in grid.slots }
+
+    solution = search(grid, domains, [ 0 ]) if consistent else None
+    if solution is None:
+        return None, pruned
+    return { s : s.words[bit] for s, bit in solution.items() }, pruned
+
+
+def run_grid(corpus, filename):
+    """ Solve a grid spec file and print the filled grid with every answer """
+    from terminaltables import AsciiTable
+    grid = load_grid(filename)
+    corpus = DecisionMaker.prepare_corpus(corpus)
+
+    start = time.perf_counter()
+    solution, pruned = solve(corpus, grid)
+    print(State.LABEL, "SOLVED {} SLOTS IN {:.3f} SECONDS".format(len(grid.slots), time.perf_counter() - start))
+
+    SLOT_DATA = [ ("Slot", "Clue", "Candidates", "After Pruning", "Answer", "Score") ]
+    for slot in grid.slots:
+        word = solution[slot] if solution else ""
+        score = slot.scores[slot.words.index(word)] if word else ""
+        SLOT_DATA.append((slot.name, slot.clue, len(slot.words), pruned[slot], word.upper(), score))
+    print("\n" + AsciiTable(SLOT_DATA, "Grid Slots").table)
+
+    if solution is None:
+        print("\nNo consistent fill found among the top {} candidates of every slot".format(State.GRID_CANDIDATES))
+    else:
+        print("\n" + "\n".join( " ".join(row) for row in grid.filled(solution) ))
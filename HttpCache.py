@@ -0,0 +1,130 @@
+"""
+HttpCache: module for an on-disk cache of fetched web pages and API responses
+
+Alex Berg and Nikki Kyllonen
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# Cache location and limits
+CACHE_FILE = "./data/cache/http_cache.sqlite"
+TTL_SECONDS = 90 * 24 * 60 * 60  # entries older than this are fetched again
+MAX_BYTES = 512 * 1024 * 1024  # oldest entries are evicted beyond this total body size
+ENABLED = os.environ.get("ACVC_HTTP_CACHE", "1") != "0"
+
+# Query parameters that are secrets and must not become part of a key
+SECRET_PARAMS = {"key"}
+REQUEST_TIMEOUT = 10  # seconds
+
+# Shared cache (opened on first use)
+cache = None
+cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    """Thread-safe sqlite store mapping a URL key to a response body."""
+
+    def __init__(self, filename, ttl=TTL_SECONDS, max_bytes=MAX_BYTES):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                        "(key TEXT PRIMARY KEY, body TEXT NOT NULL, fetched REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_fetched ON responses (fetched)")
+        self.db.execute("DELETE FROM responses WHERE fetched < ?", (time.time() - self.ttl,))
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Return the cached body for key, or None if it is missing or expired."""
+        with self.lock:
+            row = self.db.execute("SELECT body, fetched FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        return row[0]
+
+    def put(self, key, body):
+        """Store a body, evicting the oldest entries if the cache grows too large."""
+        with self.lock:
+            old = self.db.execute("SELECT LENGTH(body) FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, body, time.time()))
+            self.size += len(body) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self.evict(self.max_bytes * 9 // 10)
+            self.db.commit()
+
+    def delete(self, key):
+        """Remove a cached body, e.g. one that turned out to be invalid."""
+        with self.lock:
+            old = self.db.execute("SELECT LENGTH(body) FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                self.size -= old[0]
+
+    def evict(self, target):
+        """Delete the oldest entries until the total body size is at most target."""
+        rows = self.db.execute("SELECT key, LENGTH(body) FROM responses ORDER BY fetched")
+        evicted = []
+        for key, length in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= length
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+def get_cache():
+    """Open the shared cache on first use. Returns None when caching is disabled."""
+    global cache
+    if not ENABLED:
+        return None
+    with cache_lock:
+        if cache is None:
+            cache = ResponseCache(CACHE_FILE)
+    return cache
+
+
+def cache_key(url):
+    """Returns the url without secret query parameters such as the API key."""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def is_cached(url):
+    """Check if a url can be answered from the cache without the network."""
+    store = get_cache()
+    return store is not None and store.get(cache_key(url)) is not None
+
+
+def get_text(url, session=None):
+    """Returns the body of url, from the cache if possible. Only successful responses are
+       cached; failed ones raise requests.HTTPError."""
+    store = get_cache()
+    key = cache_key(url)
+    if store is not None:
+        body = store.get(key)
+        if body is not None:
+            return body
+
+    import requests  # deferred so loading the corpus does not pay for it
+    response = (session or requests).get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    if store is not None:
+        store.put(key, response.text)
+    return response.text
+
+
+def forget(url):
+    """Drop the cached body of url."""
+    store = get_cache()
+    if store is not None:
+        store.delete(cache_key(url))
@@ -0,0 +1,80 @@
+'''
+Profiler: module for lightweight stage timers and counters (--profile)
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import atexit, contextlib, time
+
+import State
+
+## GLOBAL VARIABLES ##
+timings = {}    # stage -> [calls, total seconds]
+counters = {}   # counter -> [events, total, max]
+profiler = None # cProfile.Profile when dumping to State.PROFILE_FILE
+noTimer = contextlib.nullcontext()
+
+
+## CLASSES ##
+class Timer:
+    """ Context manager adding the time spent inside it to a stage """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stats = timings.setdefault(self.stage, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - self.start
+        return False
+
+
+## MODULE FUNCTIONS ##
+def timer(stage):
+    """ Time a stage when profiling, otherwise do nothing """
+    return Timer(stage) if State.PROFILE else noTimer
+
+
+def count(name, n):
+    """ Record one event of size n for a counter when profiling """
+    if State.PROFILE:
+        stats = counters.setdefault(name, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += n
+        stats[2] = max(stats[2], n)
+
+
+def start():
+    """ Start collecting, print the summary at exit and, when a profile file is
+        set, run cProfile over the whole program """
+    global profiler
+    if State.PROFILE_FILE:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(report)
+
+
+def report():
+    """ Print a summary of every stage timer and counter """
+    from terminaltables import AsciiTable
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(State.PROFILE_FILE)
+        print("\n" + State.LABEL, "CPROFILE STATS WRITTEN TO", State.PROFILE_FILE)
+
+    TIMING_DATA = [ ("Stage", "Calls", "Total ms", "Mean ms") ]
+    for stage, (calls, seconds) in sorted(timings.items(), key = lambda x : x[1][1], reverse=True):
+        TIMING_DATA.append((stage, calls, "{:.3f}".format(1000 * seconds),
+                            "{:.4f}".format(1000 * seconds / calls)))
+    print("\n" + AsciiTable(TIMING_DATA, "Profile Timers").table)
+
+    COUNTER_DATA = [ ("Counter", "Events", "Total", "Mean", "Max") ]
+    for name, (events, total, most) in sorted(counters.items()):
+        COUNTER_DATA.append((name, events, total, "{:.1f}".format(total / events), most))
+    print("\n" + AsciiTable(COUNTER_DATA, "Profile Counters").table)
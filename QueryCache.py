@@ -0,0 +1,89 @@
+'''
+QueryCache: module for memoizing possible word results with LRU eviction
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import itertools, os, threading
+
+from collections import OrderedDict
+
+## GLOBAL VARIABLES ##
+corpusTokens = itertools.count()
+
+
+## CLASSES ##
+class QueryCache:
+    """ Thread-safe LRU map from a query key to its possible words. Keys start
+        with the identity of the corpus they were computed from, i.e. the
+        versions of the files it was loaded from, so a process that loads a
+        changed file never sees the entries of the old one. """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return the cached value for key (moving it to the front) or None """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """ Store a value, evicting the least recently used entries past maxSize """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Drop every entry and start the hit and miss counts over """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Hit and miss counts of the cache """
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size" : len(self.entries), "max_size" : self.maxSize,
+                    "hits" : self.hits, "misses" : self.misses,
+                    "hit_rate" : self.hits / total if total else 0.0}
+
+
+## MODULE FUNCTIONS ##
+def file_version(filename):
+    """ Identify the current contents of a file by its path, mtime and size """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return (os.path.abspath(filename), None, None)
+    return (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+
+def corpus_source(filenames, lengths=None):
+    """ Identity of a corpus loaded from the given files keeping only words of
+        the given lengths, tied to the current versions of the files """
+    return (tuple( file_version(f) for f in filenames ),
+            tuple(sorted(lengths)) if lengths else None)
+
+
+def corpus_key(corpus):
+    """ Identity of a corpus for cache keys: its corpus_source when loaded from
+        files, or a unique token for corpora built in memory """
+    key = getattr(corpus, "cacheKey", None)
+    if key is None:
+        key = corpus.source if getattr(corpus, "source", None) else next(corpusTokens)
+        corpus.cacheKey = key
+    return key
@@ -0,0 +1,209 @@
+'''
+QueryServer: module for serving ACVC queries from a warm, long-running process
+
+    GET  /health                               server and corpus status
+    GET  /stats                                query counts, latencies and cache hits
+    GET  /query?length=5&hint=...&pattern=...  possible words for one clue
+    POST /query  {"length": 5, "hint": "...", "pattern": "..."}
+    POST /query  {"queries": [{"length": 5, "hint": "..."}, ...]}
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import json, threading, time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import State, CorpusIndex, DecisionMaker
+
+## GLOBAL VARIABLES ##
+MAX_BODY_BYTES = 1 << 20
+
+
+## CLASSES ##
+class QueryStats:
+    """ Thread-safe query counters and latency totals """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.queries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+
+    def record(self, queries, seconds):
+        with self.lock:
+            self.requests += 1
+            self.queries += queries
+            self.seconds += seconds
+            self.maxSeconds = max(self.maxSeconds, seconds)
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def as_dict(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            return {"uptime_s" : uptime,
+                    "requests" : self.requests,
+                    "queries" : self.queries,
+                    "errors" : self.errors,
+                    "queries_per_minute" : 60 * self.queries / uptime if uptime > 0 else 0.0,
+                    "mean_request_ms" : 1000 * self.seconds / self.requests if self.requests else 0.0,
+                    "max_request_ms" : 1000 * self.maxSeconds}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ Answers health, stats and query requests against the server's corpus """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            self.send_json(200, {"status" : "ok",
+                                 "corpus" : self.server.corpusFile,
+                                 "words" : len(self.server.corpus),
+                                 "metric" : State.METRIC.name})
+        elif url.path == "/stats":
+            stats = self.server.stats.as_dict()
+            cache = DecisionMaker.get_query_cache()
+            stats["cache"] = cache.stats() if cache is not None else None
+            if isinstance(self.server.corpus, CorpusIndex.ShardedCorpus):
+                stats["shards"] = self.server.corpus.stats()
+            self.send_json(200, stats)
+        elif url.path == "/query":
+            params = { k : v[-1] for k, v in parse_qs(url.query).items() }
+            self.answer(params)
+        else:
+            self.send_json(404, {"error" : "unknown path " + url.path})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/query":
+            self.send_json(404, {"error" : "unknown path " + self.path})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.server.stats.record_error()
+            self.send_json(400, {"error" : "Content-Length must be a non-negative integer"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.send_json(413, {"error" : "request body too large"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.server.stats.record_error()
+            self.send_json(400, {"error" : "body is not valid JSON"})
+            return
+        self.answer(body)
+
+    def answer(self, body):
+        """ Answer one query or a batch of queries """
+        start = time.perf_counter()
+        try:
+            if isinstance(body, dict) and "queries" in body:
+                queries = [ parse_query(q, self.server.maxLength) for q in body["queries"] ]
+                possibles = DecisionMaker.get_possible_words_batch(self.server.corpus, queries)
+                result = {"results" : [ format_words(p) for p in possibles ]}
+            else:
+                queries = [ parse_query(body, self.server.maxLength) ]
+                result = {"words" : format_words(DecisionMaker.get_possible_words(self.server.corpus,
+                                                                                  *queries[0]))}
+        except (KeyError, TypeError, ValueError, ArithmeticError) as e:
+            self.server.stats.record_error()
+            self.send_json(400, {"error" : "bad query: {}".format(e)})
+            return
+
+        self.server.stats.record(len(queries), time.perf_counter() - start)
+        self.send_json(200, result)
+
+    def send_json(self, status, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if State.DEBUG:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+## HELPER FUNCTIONS ##
+def parse_query(q, maxLength):
+    """ Turn a {"length", "hint", "pattern"} dict into a (length, hint, pattern)
+        query, rejecting lengths no word of the corpus has room for """
+    length, hint, pattern = int(q["length"]), str(q["hint"]), q.get("pattern") or None
+    if length <= 0:
+        raise ValueError("length must be positive")
+    if length > maxLength:
+        raise ValueError("length must be at most {}, the longest word of the corpus".format(maxLength))
+    if pattern is not None and len(pattern) != length:
+        raise ValueError("pattern must be {} characters long".format(length))
+    return (length, hint, pattern)
+
+
+def max_length(corpus):
+    """ Length of the longest word of a prepared or sharded corpus """
+    lengths = corpus.shardFiles if isinstance(corpus, CorpusIndex.ShardedCorpus) else corpus.lengthWords
+    return max(lengths, default=0)
+
+
+def format_words(possible):
+    """ JSON-ready form of a list of (word, score, definition) tuples """
+    return [ {"word" : w, "score" : float(s), "definition" : d} for w, s, d in possible ]
+
+
+## MODULE FUNCTIONS ##
+def make_server(corpus, corpusFile, host, port):
+    """ Create a threaded HTTP server answering queries against a prepared corpus """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.corpus = corpus
+    server.corpusFile = corpusFile
+    server.stats = QueryStats()
+    server.maxLength = max_length(corpus)
+    return server
+
+
+def serve(corpus, corpusFile):
+    """ Warm up the corpus indexes and answer queries until interrupted """
+    corpus = DecisionMaker.prepare_corpus(corpus)
+
+    # Build the lazily created indexes now instead of on the first request,
+    # so request threads only ever read them: the per length rows and token
+    # matrices, the letter indexes of pattern queries and the word lookup.
+    # Shards are mapped on demand instead, so only the lengths that are asked
+    # for take memory, and the first requests for a length build that shard's
+    # indexes. Each index is stored only once it is complete, so threads
+    # racing to build the same one just repeat the work.
+    if not isinstance(corpus, CorpusIndex.ShardedCorpus):
+        lengths = sorted(corpus.lengthWords)
+        for wordLen in lengths:
+            DecisionMaker.get_possible_words(corpus, wordLen, "warm up")
+            DecisionMaker.get_possible_words(corpus, wordLen, "warm up", "_" * wordLen)
+        DecisionMaker.get_possible_words_batch(corpus, [ (wordLen, "warm up") for wordLen in lengths ])
+        corpus.word_index()
+
+    # Warm-up answers are of no use to clients and would skew the cache stats
+    cache = DecisionMaker.get_query_cache()
+    if cache is not None:
+        cache.clear()
+
+    server = make_server(corpus, corpusFile, State.SERVER_HOST, State.SERVER_PORT)
+    print(State.LABEL, "SERVING {} ON http://{}:{}".format(corpusFile, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
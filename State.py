@@ -9,20 +9,30 @@ class Metric(Enum):
     """ Enum for ACVC metrics """
     JACCARD = 1
     COSINE = 2
+    VECTOR = 3
+    GRAPH = 4
 
 class Corpora(Enum):
     """ Enum for ACVC corpora """
     DICTIONARY = 1
     THESAURUS = 2
     GOLDEN = 3
+    FUSED = 4
 
 ## GLOBAL VARIABLES ##
 LABEL = "[ACVC]"
 DEBUG = False
+PROFILE = False
+PROFILE_FILE = None
 HELP_MENU = """
     DEBUGGIN:
     --debug
         verbose terminal output to help with debugging
+    --profile <opt: cProfile output file>
+        time the load, hint cleaning, filtering, scoring, sorting and table
+        rendering stages, count candidates and scored definitions, and print
+        a summary at exit; also dumps cProfile stats when given a file
+        (timers only cover the main process when using --workers)
 
     CORPUS OPTIONS:
     --dictionary
@@ -31,12 +41,64 @@ HELP_MENU = """
         generate or evaluate suggestions using the thesaurus corpus
     --golden
         generate or evaluate suggestions using the golden corpus
+    --fused <opt: dictionary,thesaurus,golden weights, e.g. 1,0.5,2>
+        search all three corpora together in one index; a word scores the
+        weighted sum of its best definition score in each corpus (weights
+        default to 1); with --cosine every corpus keeps its own TF-IDF
+        weights
 
     METRIC OPTIONS:
     --jaccard
         generate or evaluate suggestions using the jaccard metric
     --cosine
-        generate or evaluate suggestions using cosine simularity
+        generate or evaluate suggestions using TF-IDF cosine similarity
+    --vector
+        generate or evaluate suggestions using averaged word vectors
+        (requires a word vectors file at data/word_vectors.txt)
+    --graph <opt: number of hops>
+        generate or evaluate suggestions by walking the synonym graph of the
+        corpus (meant for the thesaurus corpus) from the hint words; words
+        one hop away score 1 per hint word, two hops 0.5 (defaults to 2 hops)
+    --approx <opt: number of bands>
+        approximate the jaccard metric with MinHash/LSH candidate lookup,
+        more bands trade speed for recall (defaults to 32 bands); with --eval
+        also reports recall against the exact jaccard metric
+
+    STARTUP OPTIONS:
+    --startup
+        load the selected corpus, print how long startup took and exit
+    --compile
+        compile the selected corpus into a memory-mapped binary file under
+        data/cache/ which later runs load instead of the JSON (runs also
+        compile it on their own when it is missing, older than the JSON or
+        tokenized under other cleaning rules or stopwords)
+    --lengths <comma separated lengths, e.g. 5,6,7>
+        only load words of these lengths when compiling a corpus JSON, kept
+        in a compiled file of its own (a compiled file of the whole corpus is
+        memory-mapped whole)
+    --shards <opt: memory budget in MB>
+        split the selected corpus into one compiled file per answer length
+        under data/cache/ (rebuilt when the JSON changes) and only map the
+        lengths queries ask for, dropping the least recently used ones when
+        their files and the indexes built for them go over the budget
+        (default 256 MB); jaccard and vector metrics
+        only, since TF-IDF weights and synonym paths span every length
+    --compact
+        merge the logged new entries of the corpus files (written by the
+        corpus and golden standard builders) into the corpus JSON and exit
+
+    GRID OPTIONS:
+    --grid <grid spec JSON file> <opt: number of candidates>
+        fill a whole crossword grid from its clues: every slot gets its top
+        candidates (default 500) from the selected corpus and metric, which
+        are pruned by the crossing letters and searched best score first
+        (see GridSolver.py for the file format)
+
+    SERVER OPTIONS:
+    --serve <opt: port>
+        load the selected corpus once and answer queries over HTTP on
+        127.0.0.1 (default port 8765): GET /health, GET /stats and
+        GET /query?length=5&hint=...&pattern=... or POST /query with JSON
 
     EXPANDING GOLDEN CORPUS:
     --buildgolden
@@ -45,26 +107,78 @@ HELP_MENU = """
     EVALUATION OPTIONS:
     --eval <opt: number of samples> <opt: number of loops>
         default to 10 samples and 1 loop when evaluating suggestions
+    --eval all
+        score every answer and clue pair of the golden corpus in one batched
+        pass and report recall@1/5/10 and MRR; per-clue results are saved
+        under data/cache/ so later runs only score clues whose answer
+        length changed in the corpus
+    --cache <number>
+        remember the possible words of this many recent queries (default
+        4096, 0 disables); entries belong to the version of the corpus file
+        that was loaded, so restart a long-running process after changing it
+    --seed <number>
+        seed the evaluation sampling so runs can be repeated exactly
+    --workers <number>
+        score evaluation clues across this many processes (default 1)
 """
 
 # Default Metrics
 METRIC = Metric.JACCARD
 
+# Approximate Jaccard (MinHash/LSH) settings
+APPROX = False
+APPROX_BANDS = 32
+APPROX_ROWS = 1
+
+# Synonym graph settings
+GRAPH_HOPS = 2
+GRAPH_DECAY = 0.5
+
 # Default Evaluation
 EVAL = False
+EVAL_ALL = False
 SAMPLES = 10
 LOOPS = 1
+SEED = None
+WORKERS = 1
+QUERY_CACHE_SIZE = 4096
 
 # Default Corpora
 DICT_FILE = "data/definition_data.json"
 THESA_FILE = "data/synonym_data.json"
 GOLDEN_FILE = "data/answer_clue_data_backup_pretty.json"
 CORPORA = Corpora.DICTIONARY
+FUSED_WEIGHTS = {"dictionary" : 1.0, "thesaurus" : 1.0, "golden" : 1.0}
 BUILD_GOLD = False
+COMPILE = False
+COMPACT = False
+LENGTHS = None
+SHARDS = False
+SHARD_BUDGET_MB = 256
+
+# Grid solver
+GRID_FILE = None
+GRID_CANDIDATES = 500
+
+# Query server
+SERVE = False
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+STARTUP = False
+
+# Bundled stopword list (same words as the NLTK English stopwords corpus)
+STOPWORDS_FILE = "data/stopwords_english.txt"
+
+# Word vectors (GloVe or word2vec text format) and derived caches
+VECTORS_FILE = "data/word_vectors.txt"
+CACHE_DIRECTORY = "data/cache/"
 
 def processCommands(args):
     """ Set up program according to command line arguments """
-    global DEBUG, METRIC, SAMPLES, LOOPS, EVAL, CORPORA, BUILD_GOLD, GOLDEN_FILE
+    global DEBUG, METRIC, SAMPLES, LOOPS, EVAL, EVAL_ALL, CORPORA, BUILD_GOLD, GOLDEN_FILE
+    global APPROX, APPROX_BANDS, COMPILE, COMPACT, STARTUP, SEED, WORKERS
+    global PROFILE, PROFILE_FILE, LENGTHS, SERVE, SERVER_PORT, QUERY_CACHE_SIZE, FUSED_WEIGHTS
+    global GRID_FILE, GRID_CANDIDATES, GRAPH_HOPS, SHARDS, SHARD_BUDGET_MB
     index = 0
 
     # Set up current state
@@ -72,15 +186,51 @@ def processCommands(args):
         if (arg == "--debug"):
             DEBUG = True
             print(LABEL , "USING DEBUG MODE")
+        elif(arg == "--profile"):
+            PROFILE = True
+            print(LABEL , "USING PROFILE MODE")
+        elif(index > 0 and args[index-1] == "--profile" and not arg.startswith("--")):
+            PROFILE_FILE = arg
+        elif(index > 0 and args[index-1] == "--eval" and arg == "all"):
+            EVAL_ALL = True
+        elif(index > 0 and args[index-1] == "--grid"):
+            GRID_FILE = arg
+        elif(index > 0 and args[index-1] == "--lengths"):
+            LENGTHS = set( int(n) for n in arg.split(",") )
+        elif(index > 0 and args[index-1] == "--fused" and not arg.startswith("--")):
+            FUSED_WEIGHTS = dict(zip(("dictionary", "thesaurus", "golden"),
+                                     ( float(w) for w in arg.split(",") )))
         elif(arg == "--jaccard"):
             METRIC = Metric.JACCARD
         elif(arg == "--cosine"):
             METRIC = Metric.COSINE
+        elif(arg == "--vector"):
+            METRIC = Metric.VECTOR
+        elif(arg == "--graph"):
+            METRIC = Metric.GRAPH
         elif(arg == "--eval"):
             EVAL = True
+        elif(arg == "--approx"):
+            APPROX = True
         elif(arg.isnumeric()):
-            if index > 0 and args[index-1] == "--eval":
+            if index > 0 and args[index-1] == "--approx":
+                APPROX_BANDS = int(arg)
+            elif index > 0 and args[index-1] == "--graph":
+                GRAPH_HOPS = int(arg)
+            elif index > 0 and args[index-1] == "--seed":
+                SEED = int(arg)
+            elif index > 0 and args[index-1] == "--workers":
+                WORKERS = int(arg)
+            elif index > 0 and args[index-1] == "--serve":
+                SERVER_PORT = int(arg)
+            elif index > 0 and args[index-1] == "--shards":
+                SHARD_BUDGET_MB = int(arg)
+            elif index > 0 and args[index-1] == "--cache":
+                QUERY_CACHE_SIZE = int(arg)
+            elif index > 0 and args[index-1] == "--eval":
                 SAMPLES = int(arg)
+            elif index > 1 and args[index-2] == "--grid":
+                GRID_CANDIDATES = int(arg)
             elif index > 0 and args[index-1].isnumeric():
                 LOOPS = int(arg)
         elif(arg == "--dictionary"):
@@ -89,6 +239,18 @@ def processCommands(args):
             CORPORA = CORPORA.THESAURUS
         elif(arg == "--golden"):
             CORPORA = CORPORA.GOLDEN
+        elif(arg == "--fused"):
+            CORPORA = CORPORA.FUSED
+        elif(arg == "--compile"):
+            COMPILE = True
+        elif(arg == "--compact"):
+            COMPACT = True
+        elif(arg == "--shards"):
+            SHARDS = True
+        elif(arg == "--serve"):
+            SERVE = True
+        elif(arg == "--startup"):
+            STARTUP = True
         elif(arg == "--buildgold"):
             BUILD_GOLD = True
             print(LABEL , "ADDING TO GOLDEN STANDARD CORPUS")
@@ -104,6 +266,22 @@ def processCommands(args):
     # Output current state
     if not BUILD_GOLD:
         print(LABEL , "USING {} METRIC".format(METRIC.name))
+        if METRIC == Metric.GRAPH:
+            print(LABEL , "WALKING UP TO {} SYNONYM HOPS".format(GRAPH_HOPS))
+        if APPROX:
+            print(LABEL , "APPROXIMATING JACCARD WITH {} LSH BANDS".format(APPROX_BANDS))
         print(LABEL , "USING {} CORPUS".format(CORPORA.name))
-        if EVAL:
-            print(LABEL , "EVALUATING USING {0} SAMPLES and {1} LOOP(S)".format(SAMPLES, LOOPS))
\ No newline at end of file
+        if CORPORA == Corpora.FUSED:
+            print(LABEL , "WEIGHTING CORPORA {}".format(FUSED_WEIGHTS))
+        if LENGTHS:
+            print(LABEL , "LOADING ONLY WORDS OF LENGTHS {}".format(sorted(LENGTHS)))
+        if SHARDS:
+            print(LABEL , "LOADING LENGTH SHARDS ON DEMAND WITHIN {} MB".format(SHARD_BUDGET_MB))
+        if GRID_FILE:
+            print(LABEL , "SOLVING GRID {} WITH {} CANDIDATES PER SLOT".format(GRID_FILE, GRID_CANDIDATES))
+        if EVAL_ALL:
+            print(LABEL , "EVALUATING USING EVERY GOLDEN CLUE")
+        elif EVAL:
+            print(LABEL , "EVALUATING USING {0} SAMPLES and {1} LOOP(S)".format(SAMPLES, LOOPS))
+        if EVAL and WORKERS > 1:
+            print(LABEL , "EVALUATING ACROSS {} WORKERS".format(WORKERS))
\ No newline at end of file
@@ -0,0 +1,105 @@
+'''
+VectorStore: module for locally stored word vectors and definition vectors
+
+Alex Berg and Nikki Kyllonen
+'''
+from __future__ import print_function
+
+import hashlib, os
+
+import numpy as np
+
+
+## CLASSES ##
+class WordVectors:
+    """ Word vectors converted once from a text vectors file (GloVe or word2vec
+        text format) into a float32 .npy matrix that is memory-mapped on load """
+
+    def __init__(self, vectorsFile, cacheDir):
+        self.source = vectorsFile
+        base = os.path.join(cacheDir, os.path.basename(vectorsFile))
+        matrixFile, vocabFile = base + ".npy", base + ".vocab"
+
+        if not is_fresh(matrixFile, vectorsFile) or not is_fresh(vocabFile, vectorsFile):
+            convert_vectors_file(vectorsFile, matrixFile, vocabFile)
+
+        with open(vocabFile, "r") as f:
+            self.vocab = { w.rstrip("\n") : i for i, w in enumerate(f) }
+        self.matrix = np.load(matrixFile, mmap_mode="r")
+        self.dim = self.matrix.shape[1]
+
+    def average(self, tokens):
+        """ Unit length average of the vectors of every known token """
+        return self.average_rows(sorted( self.vocab[t] for t in tokens if t in self.vocab ))
+
+    def average_rows(self, rows):
+        """ Unit length average of the given rows of the vector matrix """
+        if len(rows) == 0:
+            return np.zeros(self.dim, dtype=np.float32)
+        vec = np.asarray(self.matrix[rows], dtype=np.float32).mean(axis=0)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+
+class SentenceIndex:
+    """ Averaged vector of every definition of a prepared corpus, stored as a
+        float32 .npy matrix and memory-mapped so startup does not load it """
+
+    def __init__(self, prepared, wordVectors, cacheDir):
+        self.prepared = prepared
+        self.wordVectors = wordVectors
+
+        matrixFile = os.path.join(cacheDir, "sentences-{}.npy".format(fingerprint(prepared, wordVectors)))
+        if not os.path.exists(matrixFile):
+            # Map corpus token ids to vector rows once (-1 for unknown tokens)
+            vocabRows = np.array([ wordVectors.vocab.get(t, -1) for t in prepared.vocab ],
+                                 dtype=np.int64)
+            starts, ids = prepared.tokens.starts, prepared.tokens.ids
+            matrix = np.zeros((len(prepared.definitions), wordVectors.dim), dtype=np.float32)
+            for defId in range(len(matrix)):
+                rows = vocabRows[ids[starts[defId]:starts[defId + 1]]]
+                matrix[defId] = wordVectors.average_rows(np.sort(rows[rows >= 0]))
+            save_npy(matrixFile, matrix)
+        self.matrix = np.load(matrixFile, mmap_mode="r")
+
+
+## MODULE FUNCTIONS ##
+def is_fresh(target, source):
+    """ Check that target exists and is newer than source """
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def save_npy(filename, matrix):
+    """ Write a .npy file atomically so a crash never leaves a partial cache """
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, matrix)
+    os.replace(tmp, filename)
+
+
+def convert_vectors_file(vectorsFile, matrixFile, vocabFile):
+    """ Parse a text vectors file into a .npy matrix and a vocabulary file """
+    print("Converting word vectors file '{0}'...".format(vectorsFile))
+    words, vectors = [], []
+    with open(vectorsFile, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip().split(" ")
+            if len(parts) <= 2:     # word2vec header line or blank line
+                continue
+            words.append(parts[0])
+            vectors.append(np.array(parts[1:], dtype=np.float32))
+
+    save_npy(matrixFile, np.vstack(vectors))
+    with open(vocabFile, "w") as f:
+        f.write("".join( w + "\n" for w in words ))
+
+
+def fingerprint(prepared, wordVectors):
+    """ Hash identifying a corpus and vectors file pair for the sentence cache """
+    h = hashlib.sha1()
+    h.update(os.path.abspath(wordVectors.source).encode("utf-8"))
+    h.update(str(os.path.getmtime(wordVectors.source)).encode("utf-8"))
+    for name in ("words", "wordOffsets", "definitions", "definitionOffsets", "wordStart"):
+        h.update(np.ascontiguousarray(prepared.arrays[name]).tobytes())
+    return h.hexdigest()[:16]